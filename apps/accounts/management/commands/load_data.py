@@ -0,0 +1,191 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core import serializers
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+# characters allowed between the objects of a JSON array or NDJSON file
+SEPARATORS = ' \t\r\n,[]'
+
+
+def iter_json_objects(stream, chunk_size=64 * 1024):
+    """
+    Yield the objects of a JSON array, or of newline delimited JSON, while
+    only holding a chunk of the file (and the object being read) in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in iter(lambda: stream.read(chunk_size), ''):
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                obj, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the object continues in the next chunk
+                break
+            yield obj
+        buffer = buffer[position:]
+    if buffer.strip(SEPARATORS):
+        raise ValueError('Invalid JSON: {!r}'.format(buffer[:80]))
+
+
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def hash_passwords(passwords):
+    """
+    Hash raw passwords, leaving already hashed ones alone. Runs in a worker
+    process; None becomes an unusable password.
+    """
+    hashed = []
+    for password in passwords:
+        if password is not None:
+            try:
+                identify_hasher(password)
+            except ValueError:
+                pass
+            else:
+                hashed.append(password)
+                continue
+        hashed.append(make_password(password))
+    return hashed
+
+
+class Command(BaseCommand):
+    help = ('Load model JSON from json_data/. Each <app_label>.<Model>.json '
+            'file holds a JSON array (or newline delimited JSON) of objects, '
+            'either field values or fixture style {"pk", "fields"} objects.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='*',
+            help='Files to load, in order. Defaults to every .json file in '
+                 '--directory, sorted by name.')
+        parser.add_argument(
+            '--directory', default=os.path.join(settings.BASE_DIR, 'json_data'),
+            help='Where to look for files.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Objects per bulk insert and transaction.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Processes hashing passwords.')
+
+    def handle(self, *args, **options):
+        files = options['files'] or sorted(
+            glob.glob(os.path.join(options['directory'], '*.json')))
+        if not files:
+            raise CommandError('No files to load.')
+        self.options = options
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            self.pool = pool
+            for path in files:
+                self.load_file(path)
+
+    def load_file(self, path):
+        label = os.path.splitext(os.path.basename(path))[0]
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError):
+            raise CommandError(
+                '{} is not named after a model, e.g. accounts.EmailUser.json'
+                .format(path))
+        has_password = 'password' in {
+            field.name for field in model._meta.concrete_fields}
+        count = 0
+        start = self.last_report = time.perf_counter()
+
+        with open(path, encoding='utf-8') as stream:
+            batches = iter_batches(
+                iter_json_objects(stream), self.options['batch_size'])
+            # hash the next batch's passwords while this one is inserted
+            pending = None
+            try:
+                for batch in batches:
+                    batch = [self.to_fixture(label, obj) for obj in batch]
+                    hashing = (self.start_hashing(batch) if has_password
+                               else None)
+                    if pending is not None:
+                        count += self.save_batch(model, *pending)
+                        if time.perf_counter() - self.last_report > 5:
+                            self.report(path, count, start)
+                    pending = batch, hashing
+                if pending is not None:
+                    count += self.save_batch(model, *pending)
+            except (ValueError, FieldDoesNotExist,
+                    serializers.base.DeserializationError) as e:
+                raise CommandError('{}, after {} objects: {}'.format(
+                    path, count, e))
+        self.report(path, count, start, style=self.style.SUCCESS)
+
+    def to_fixture(self, label, obj):
+        """Objects are either fixture style or just field values."""
+        if 'fields' in obj:
+            return dict(obj, model=label)
+        fields = dict(obj)
+        fixture = {'model': label, 'fields': fields}
+        if 'pk' in fields:
+            fixture['pk'] = fields.pop('pk')
+        return fixture
+
+    def start_hashing(self, batch):
+        passwords = [obj['fields'].get('password') for obj in batch]
+        workers = self.options['workers']
+        chunk_size = -(-len(passwords) // workers)
+        return [self.pool.submit(hash_passwords, passwords[i:i + chunk_size])
+                for i in range(0, len(passwords), chunk_size)]
+
+    def save_batch(self, model, batch, hashing):
+        if hashing is not None:
+            passwords = [password for future in hashing
+                         for password in future.result()]
+            for obj, password in zip(batch, passwords):
+                obj['fields']['password'] = password
+        objects = list(serializers.deserialize('python', batch))
+        # bulk_create sends no post_save signals, so e.g. no validation
+        # emails go out for loaded users
+        with transaction.atomic():
+            model._default_manager.bulk_create(
+                [deserialized.object for deserialized in objects])
+            self.save_many_to_many(model, objects)
+        return len(objects)
+
+    def save_many_to_many(self, model, objects):
+        for name in {name for deserialized in objects
+                     for name in deserialized.m2m_data}:
+            field = model._meta.get_field(name)
+            through = field.remote_field.through
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_field_name() + '_id'
+            through._default_manager.bulk_create([
+                through(**{source: deserialized.object.pk, target: value})
+                for deserialized in objects
+                for value in deserialized.m2m_data.get(name, ())])
+
+    def report(self, path, count, start, style=None):
+        self.last_report = time.perf_counter()
+        elapsed = self.last_report - start
+        message = '{}: {} objects loaded in {:.1f}s, {:.0f} objects/s'.format(
+            path, count, elapsed, count / elapsed if elapsed else 0)
+        self.stdout.write(style(message) if style else message)
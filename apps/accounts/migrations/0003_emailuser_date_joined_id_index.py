@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 11:21
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_emailuser_gravatar_cache'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='emailuser',
+            index_together=set([('date_joined', 'id')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 11:26
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_emailuser_date_joined_id_index'),
+        # outstanding keys are copied to UserKey first
+        ('base_accounts', '0003_copy_validation_keys'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='emailuser',
+            name='validation_key',
+        ),
+    ]
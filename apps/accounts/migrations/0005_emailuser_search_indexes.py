@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+SEARCH_COLUMNS = ('email', 'first_name', 'last_name', 'preferred_name')
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    Trigram indexes on UPPER(column::text), the expression Django's icontains
+    compiles to on Postgres, so user search doesn't scan the table. They're
+    built concurrently so signups and logins can write to the table meanwhile.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('accounts', 'EmailUser')._meta.db_table
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in SEARCH_COLUMNS:
+        name = '{table}_{column}_trgm'.format(table=table, column=column)
+        # a failed concurrent build leaves an invalid index behind, which
+        # IF NOT EXISTS would keep
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT NOT indisvalid FROM pg_index '
+                'WHERE indexrelid = to_regclass(%s)', [name])
+            row = cursor.fetchone()
+        if row is not None and row[0]:
+            schema_editor.execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+        schema_editor.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} '
+            'USING gin (UPPER({column}::text) gin_trgm_ops)'.format(
+                name=name, table=table, column=column))
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('accounts', 'EmailUser')._meta.db_table
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(
+            'DROP INDEX CONCURRENTLY IF EXISTS {table}_{column}_trgm'.format(
+                table=table, column=column))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0004_remove_emailuser_validation_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
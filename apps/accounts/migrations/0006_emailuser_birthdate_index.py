@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 11:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_emailuser_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailuser',
+            name='birthdate',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='Birth date'),
+        ),
+    ]
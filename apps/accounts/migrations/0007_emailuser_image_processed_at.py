@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 11:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_emailuser_birthdate_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailuser',
+            name='image_processed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
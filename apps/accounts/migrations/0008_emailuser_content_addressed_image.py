@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 11:38
+from __future__ import unicode_literals
+
+import apps.base_accounts.models
+import apps.base_accounts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_emailuser_image_processed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailuser',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=apps.base_accounts.storage.ContentAddressedStorage(), upload_to=apps.base_accounts.models.user_image_upload_to),
+        ),
+    ]
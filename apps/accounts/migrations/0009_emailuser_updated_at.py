@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 12:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_emailuser_content_addressed_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailuser',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
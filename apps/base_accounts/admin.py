@@ -1,7 +1,10 @@
+import datetime
+
 from django import forms
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.admin.sites import NotRegistered
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import (ReadOnlyPasswordHashField,
@@ -9,6 +12,10 @@ from django.contrib.auth.forms import (ReadOnlyPasswordHashField,
                                        UserCreationForm)
 from django.contrib.auth.models import Group
 
+from .functions import Age
+from .pagination import EstimatedCountPaginator
+from .search import SEARCH_FIELDS, search_users
+
 
 class SettingsUserForAdmin:
     def __init__(self, *args, **kwargs):
@@ -89,18 +96,96 @@ class MyUserCreationForm(SettingsUserForAdmin,
         raise forms.ValidationError(self.error_messages['duplicate_email'])
 
 
+def years_ago(today, years):
+    """The date `years` years before today (Feb 29 becomes Feb 28)."""
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        return today.replace(year=today.year - years, day=28)
+
+
+class AgeListFilter(admin.SimpleListFilter):
+    """
+    Filters users into age buckets. Buckets are turned into birthdate ranges,
+    so the filter uses the birthdate index rather than computing ages.
+    """
+    title = 'age'
+    parameter_name = 'age'
+    buckets = [
+        # (value, label, youngest age, oldest age)
+        ('0-17', 'Under 18', 0, 17),
+        ('18-24', '18 to 24', 18, 24),
+        ('25-34', '25 to 34', 25, 34),
+        ('35-44', '35 to 44', 35, 44),
+        ('45-54', '45 to 54', 45, 54),
+        ('55-64', '55 to 64', 55, 64),
+        ('65-', '65 and over', 65, None),
+    ]
+
+    def lookups(self, request, model_admin):
+        return [(value, label) for value, label, low, high in self.buckets] + [
+            ('unknown', 'Unknown')]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'unknown':
+            return queryset.filter(birthdate__isnull=True)
+        for value, label, low, high in self.buckets:
+            if self.value() == value:
+                today = datetime.date.today()
+                queryset = queryset.filter(
+                    birthdate__lte=years_ago(today, low))
+                if high is not None:
+                    queryset = queryset.filter(
+                        birthdate__gt=years_ago(today, high + 1))
+                return queryset
+        return queryset
+
+
+class EmailUserChangeList(ChangeList):
+    def is_ranked(self):
+        """Whether results keep the search's relevance order."""
+        return bool(self.query) and ORDER_VAR not in self.params
+
+    def get_ordering(self, request, queryset):
+        # the admin's default ordering would come before the search rank
+        # (Django orders the searched queryset from 1.11 on)
+        if self.is_ranked():
+            return list(queryset.query.order_by)
+        return super().get_ordering(request, queryset)
+
+    def get_ordering_field_columns(self):
+        # no column is sorted on while ranked
+        if self.is_ranked():
+            return {}
+        return super().get_ordering_field_columns()
+
+    def get_queryset(self, request):
+        # only load the columns the changelist shows
+        return super().get_queryset(request).only(
+            *self.model_admin.list_display_columns).annotate(
+                age_years=Age('birthdate'))
+
+
 class EmailUserAdmin(UserAdmin):
     form = UserChangeForm
     add_form = MyUserCreationForm
     change_password_form = AdminPasswordChangeForm
     actions_on_bottom = True
     ordering = ('email',)
-    list_filter = ()
-    readonly_fields = ('image_tag',)
+    list_filter = (AgeListFilter,)
+    readonly_fields = ('image_tag', 'image_processed_at', 'has_gravatar',
+                       'gravatar_checked_at')
     list_display = ('email', 'first_name', 'last_name', 'preferred_name',
                     'phone', 'gender', 'age', 'birthdate', 'is_superuser',
                     'is_developer')
-    search_fields = ('email', 'last_name', 'preferred_name', 'first_name')
+    # model columns needed to render list_display
+    list_display_columns = ('email', 'first_name', 'last_name',
+                            'preferred_name', 'phone', 'gender', 'birthdate',
+                            'is_superuser', 'is_developer')
+    # skip the unfiltered COUNT(*) shown next to filtered result counts
+    show_full_result_count = False
+    search_fields = SEARCH_FIELDS
+    paginator = EstimatedCountPaginator
     add_fieldsets = (
         (None, {
             'classes': ('wide',),
@@ -113,10 +198,12 @@ class EmailUserAdmin(UserAdmin):
                 'email', 'password',
                 ('first_name', 'last_name', 'preferred_name'),
                 ('image', 'image_tag'),
+                ('image_processed_at',),
+                ('has_gravatar', 'gravatar_checked_at'),
                 'gender',
                 'phone',
                 'birthdate',
-                ('validation_key', 'validated_at',),
+                'validated_at',
             ),
         }),
         ('Roles', {
@@ -126,3 +213,26 @@ class EmailUserAdmin(UserAdmin):
             ),
         }),
     )
+
+    def get_search_results(self, request, queryset, search_term):
+        # same trigram-indexed lookups as the API search
+        if not search_term:
+            return queryset, False
+        results = search_users(queryset, search_term)
+        if ORDER_VAR in request.GET:
+            # a column sort beats the rank; Django 1.10 orders the queryset
+            # before searching it
+            results = results.order_by(*queryset.query.order_by)
+        return results, False
+
+    def get_changelist(self, request, **kwargs):
+        return EmailUserChangeList
+
+    def age(self, obj):
+        # the model's age is 0 without a birthdate; show it as unknown
+        if not obj.birthdate:
+            return self.get_empty_value_display()
+        # annotated by the changelist
+        return getattr(obj, 'age_years', obj.age)
+    # same order as sorting by age_years, but served by the birthdate index
+    age.admin_order_field = '-birthdate'
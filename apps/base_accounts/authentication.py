@@ -0,0 +1,57 @@
+from django.core.cache import cache
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .conf import get_setting
+
+TOKEN_CACHE_KEY = 'auth-token:{}'
+USER_TOKEN_CACHE_KEY = 'auth-token-user:{}'
+
+
+def get_token(key):
+    """
+    Returns the Token (with its user loaded) for a key, or None if the key
+    is invalid. Tokens are cached for a short time to keep the lookup off
+    the hot path of authenticated requests.
+    """
+    cache_key = TOKEN_CACHE_KEY.format(key)
+    token = cache.get(cache_key)
+    if token is None:
+        try:
+            token = Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+        timeout = get_setting('TOKEN_CACHE_TTL')
+        cache.set(cache_key, token, timeout)
+        # remember the user's token so user changes can invalidate it
+        cache.set(USER_TOKEN_CACHE_KEY.format(token.user_id), key, timeout)
+    return token
+
+
+def invalidate_token(key):
+    cache.delete(TOKEN_CACHE_KEY.format(key))
+
+
+def invalidate_user_token(user_id):
+    key = cache.get(USER_TOKEN_CACHE_KEY.format(user_id))
+    if key is not None:
+        cache.delete_many([TOKEN_CACHE_KEY.format(key),
+                           USER_TOKEN_CACHE_KEY.format(user_id)])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that caches the token and user, so authenticated
+    requests don't query the database before the view runs.
+    """
+    def authenticate_credentials(self, key):
+        token = get_token(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
@@ -0,0 +1,194 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.validators import UniqueValidator
+
+from .authentication import invalidate_user_token
+from .caching import invalidate_user_data
+from .serializers import CreateUserSerializer, UserSerializer
+
+
+class BulkCreateUserSerializer(CreateUserSerializer):
+    """
+    Leaves email uniqueness to bulk_save_users(), which checks a whole batch
+    with one query instead of one per user.
+    """
+    def get_fields(self):
+        fields = super().get_fields()
+        email = fields['email']
+        self.unique_email_message = next(
+            (validator.message for validator in email.validators
+             if isinstance(validator, UniqueValidator)), None)
+        email.validators = [validator for validator in email.validators
+                            if not isinstance(validator, UniqueValidator)]
+        return fields
+
+
+def _error(errors, status_code=status.HTTP_400_BAD_REQUEST):
+    return {'status': status_code, 'errors': errors}
+
+
+def _email_taken_error(context):
+    serializer = BulkCreateUserSerializer(context=context)
+    # building the fields looks up the message
+    serializer.fields
+    return _error({'email': [serializer.unique_email_message]})
+
+
+def _validate_creates(model, items, context, results):
+    """Validate new users, returning {index: validated_data}."""
+    valid = {}
+    serializer = None
+    for index, item in items:
+        serializer = BulkCreateUserSerializer(data=item, context=context)
+        if serializer.is_valid():
+            valid[index] = serializer.validated_data
+        else:
+            results[index] = _error(serializer.errors)
+    if not valid:
+        return valid
+
+    # emails must be unique within the batch and not taken already
+    emails = [data['email'] for data in valid.values()]
+    taken = set(model._default_manager.filter(
+        email__in=emails).values_list('email', flat=True))
+    seen = set()
+    for index, data in list(valid.items()):
+        if data['email'] in taken or data['email'] in seen:
+            results[index] = _error(
+                {'email': [serializer.unique_email_message]})
+            del valid[index]
+        seen.add(data['email'])
+    return valid
+
+
+def _validate_updates(model, items, context, results):
+    """
+    Validate partial updates, loading every user with one query. Returns
+    {index: (user, changed field names)} with the changes applied.
+    """
+    pks = {}
+    for index, item in items:
+        try:
+            pks[index] = model._meta.pk.to_python(item['id'])
+        except DjangoValidationError as e:
+            results[index] = _error({'id': e.messages})
+    users = model._default_manager.in_bulk(list(pks.values()))
+
+    valid = {}
+    seen = set()
+    for index, item in items:
+        if index not in pks:
+            continue
+        user = users.get(pks[index])
+        if user is None:
+            results[index] = _error(
+                {'id': ['Not found.']}, status.HTTP_404_NOT_FOUND)
+            continue
+        if user.pk in seen:
+            results[index] = _error({'id': ['Updated twice in one request.']})
+            continue
+        seen.add(user.pk)
+        serializer = UserSerializer(
+            user, data=item, partial=True, context=context)
+        if not serializer.is_valid():
+            results[index] = _error(serializer.errors)
+            continue
+        for name, value in serializer.validated_data.items():
+            setattr(user, name, value)
+        valid[index] = (user, set(serializer.validated_data))
+    return valid
+
+
+def _create(model, valid, context, results):
+    users = {}
+    for index, data in valid.items():
+        data = dict(data)
+        password = data.pop('password', None)
+        user = model(**data)
+        if password:
+            user.set_password(password)
+        users[index] = user
+    manager = model._default_manager
+    try:
+        with transaction.atomic():
+            manager.bulk_create(users.values())
+    except IntegrityError:
+        # a concurrent request took an email since we checked; find out
+        # which by inserting the users one at a time
+        for index, user in list(users.items()):
+            try:
+                with transaction.atomic():
+                    manager.bulk_create([user])
+            except IntegrityError:
+                results[index] = _email_taken_error(context)
+                del users[index]
+    return users
+
+
+def _update(model, valid):
+    """Apply every update with a single UPDATE ... SET f = CASE ... query."""
+    changes = {}
+    for user, fields in valid.values():
+        for name in fields:
+            changes.setdefault(name, []).append(user)
+    values = {}
+    for name, users in changes.items():
+        field = model._meta.get_field(name)
+        values[field.attname] = Case(
+            *[When(pk=user.pk, then=Value(
+                getattr(user, field.attname), output_field=field))
+              for user in users],
+            default=F(field.attname), output_field=field)
+    if values:
+        now = timezone.now()
+        for user, fields in valid.values():
+            user.updated_at = now
+        model._default_manager.filter(pk__in=[
+            user.pk for user, fields in valid.values()]).update(
+                updated_at=now, **values)
+
+
+def bulk_save_users(model, items, context):
+    """
+    Create (items without an id) and partially update (items with one) many
+    users. Every item is validated first, with batched queries, then all
+    valid items are written in one transaction: a bulk INSERT, a single
+    UPDATE and, once committed, the new users' validation emails.
+
+    Returns a result per item, in order: the status code and either the
+    user's data or the errors.
+    """
+    results = [None] * len(items)
+    creates, updates = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = _error({'non_field_errors': [
+                'Expected an object, got {}.'.format(type(item).__name__)]})
+        elif item.get('id') is not None:
+            updates.append((index, item))
+        else:
+            creates.append((index, item))
+
+    valid_creates = _validate_creates(model, creates, context, results)
+    valid_updates = _validate_updates(model, updates, context, results)
+
+    with transaction.atomic():
+        created = _create(model, valid_creates, context, results)
+        _update(model, valid_updates)
+        # post_save isn't sent for bulk writes, so do what its receivers do
+        if created:
+            model.send_validation_emails(list(created.values()))
+    for user, fields in valid_updates.values():
+        invalidate_user_token(user.pk)
+    invalidate_user_data(*[user.pk for user, fields in valid_updates.values()])
+
+    for index, user in created.items():
+        results[index] = {'status': status.HTTP_201_CREATED,
+                          'data': UserSerializer(user, context=context).data}
+    for index, (user, fields) in valid_updates.items():
+        results[index] = {'status': status.HTTP_200_OK,
+                          'data': UserSerializer(user, context=context).data}
+    return results
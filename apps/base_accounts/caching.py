@@ -0,0 +1,53 @@
+import uuid
+from collections import Counter
+
+from django.core.cache import cache
+
+from .conf import get_setting
+
+USER_DATA_CACHE_KEY = 'user-data:{}:{}:{}'
+USER_DATA_GENERATION_CACHE_KEY = 'user-data-generation:{}'
+
+# hits and misses of the user data cache in this process
+user_data_stats = Counter()
+
+
+def get_user_data_generation(pk):
+    """
+    Returns the current generation of a user's cached representations.
+    Invalidating deletes it and the next read starts a random new one, so
+    the old entries are never read again, even if the generation is
+    evicted from the cache.
+    """
+    key = USER_DATA_GENERATION_CACHE_KEY.format(pk)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def get_cached_user_data(pk, variant):
+    """
+    Looks up a representation of a user, where variant names the serializer
+    and request details it depends on. Returns (key, cached value or None);
+    on a miss, store the value with cache_user_data(key, ...).
+
+    Read the generation before loading the user, and invalidate after the
+    change is committed, so that a representation cached from a stale read
+    is filed under an old generation.
+    """
+    key = USER_DATA_CACHE_KEY.format(pk, get_user_data_generation(pk), variant)
+    value = cache.get(key)
+    user_data_stats['hits' if value is not None else 'misses'] += 1
+    return key, value
+
+
+def cache_user_data(key, value):
+    cache.set(key, value, get_setting('USER_DATA_CACHE_TTL'))
+
+
+def invalidate_user_data(*pks):
+    cache.delete_many([USER_DATA_GENERATION_CACHE_KEY.format(pk)
+                       for pk in pks])
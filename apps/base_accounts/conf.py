@@ -0,0 +1,77 @@
+from django.conf import settings
+
+# Defaults for the settings.radius['ACCOUNTS'] dictionary.
+DEFAULTS = {
+    # Email outbox
+    'OUTBOX_BATCH_SIZE': 50,
+    'OUTBOX_MAX_ATTEMPTS': 8,
+    'OUTBOX_RETRY_DELAY': 60,  # seconds, doubled after every failed attempt
+    'OUTBOX_MAX_RETRY_DELAY': 60 * 60,
+    'OUTBOX_POLL_INTERVAL': 5,
+
+    # Gravatar existence cache, in seconds
+    'GRAVATAR_TTL': 7 * 24 * 60 * 60,
+    'GRAVATAR_NEGATIVE_TTL': 24 * 60 * 60,
+    'GRAVATAR_TIMEOUT': 5,
+
+    # User list pagination
+    'USER_PAGE_SIZE': 100,
+    'USER_MAX_PAGE_SIZE': 1000,
+    'USER_SEARCH_LIMIT': 50,
+    # Most users fetched by one ?ids= or lookup request
+    'USER_MULTI_GET_MAX_IDS': 500,
+    # Most users created or updated by one bulk request
+    'BULK_MAX_USERS': 1000,
+
+    # Users fetched per query by the streaming export
+    'EXPORT_CHUNK_SIZE': 2000,
+    # Paginated querysets larger than this (by the Postgres planner's
+    # estimate) report the estimate instead of an exact COUNT(*)
+    'ESTIMATED_COUNT_THRESHOLD': 100000,
+
+    # Largest accepted profile image upload, in bytes
+    'IMAGE_UPLOAD_MAX_SIZE': 10 * 1024 * 1024,
+
+    # Profile image variants, rendered in a process pool after upload
+    'IMAGE_VARIANT_SIZES': (20, 80, 256),
+    'IMAGE_VARIANT_FORMATS': ('webp', 'jpeg'),
+    'IMAGE_VARIANT_QUALITY': 85,
+    'IMAGE_PROCESS_WORKERS': 2,
+
+    # Failed logins allowed per client IP and per email within a sliding
+    # window of seconds; beyond that /api-token-auth/ answers 429 without
+    # checking the password
+    'LOGIN_FAILURE_WINDOW': 15 * 60,
+    'LOGIN_MAX_FAILURES_PER_IP': 50,
+    'LOGIN_MAX_FAILURES_PER_EMAIL': 10,
+
+    # Token bucket rates of the views that email any address a client
+    # submits, by throttle scope and bucket: per client IP, per target
+    # email and for everyone together
+    'THROTTLE_RATES': {
+        'reset_password': {'ip': '10/hour', 'email': '3/hour',
+                           'global': '1000/hour'},
+        'create_user': {'ip': '20/hour', 'email': '3/hour',
+                        'global': '1000/hour'},
+    },
+
+    # Seconds an API token and its user are cached for
+    'TOKEN_CACHE_TTL': 60,
+    # Seconds a user's serialized representation is cached for; writes
+    # invalidate it, 0 turns the cache off
+    'USER_DATA_CACHE_TTL': 60 * 60,
+
+    # Seconds that emailed validation and password reset links stay valid
+    'VALIDATION_KEY_TTL': 30 * 24 * 60 * 60,
+    'RESET_PASSWORD_KEY_TTL': 24 * 60 * 60,
+    'EXPIRED_KEY_PURGE_BATCH_SIZE': 1000,
+}
+
+
+def get_setting(name):
+    """
+    Return an accounts setting from settings.radius['ACCOUNTS'], falling back
+    to the default defined above.
+    """
+    accounts_settings = getattr(settings, 'radius', {}).get('ACCOUNTS', {})
+    return accounts_settings.get(name, DEFAULTS[name])
@@ -0,0 +1,140 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.template import Context, Variable, VariableDoesNotExist
+from django.template.base import TextNode, VariableNode, \
+    render_value_in_context
+from django.template.defaulttags import LoadNode
+from django.template.loader import get_template
+from django.template.loader_tags import BlockNode, ExtendsNode
+
+# Context variables that change from one recipient to the next. Everything
+# else in an email template (the EmailSettings chrome) is rendered once.
+PER_RECIPIENT_VARIABLES = ('user', 'url')
+
+_MARKER = '\x1f{}\x1f'
+_MARKER_RE = re.compile('\x1f([\\w.]+)\x1f')
+
+
+class _Placeholder:
+    """
+    Stands in for a per-recipient context variable while the skeleton is
+    rendered, printing a marker with the variable path in its place.
+    """
+    def __init__(self, path):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Placeholder('{}.{}'.format(self._path, name))
+
+    def __getitem__(self, key):
+        raise TypeError('Placeholders only support attribute lookups.')
+
+    def __str__(self):
+        return _MARKER.format(self._path)
+
+
+def _is_per_recipient(variable):
+    return (isinstance(variable, Variable) and
+            variable.var.split('.')[0] in PER_RECIPIENT_VARIABLES)
+
+
+def _skeleton_safe(nodelist, engine):
+    """
+    Whether a template renders the same from the skeleton as in full. The
+    skeleton pass can't tell what a tag or filter would do with a
+    per-recipient variable, so the template may only hold text, blocks, a
+    fixed {% extends %}, plain {{ variables }}, and filters on variables
+    that aren't per recipient.
+    """
+    for node in nodelist:
+        if isinstance(node, (TextNode, LoadNode)):
+            continue
+        if isinstance(node, VariableNode):
+            expression = node.filter_expression
+            if expression.filters and (
+                    _is_per_recipient(expression.var) or any(
+                        lookup and _is_per_recipient(arg)
+                        for func, args in expression.filters
+                        for lookup, arg in args)):
+                return False
+        elif isinstance(node, BlockNode):
+            if not _skeleton_safe(node.nodelist, engine):
+                return False
+        elif (isinstance(node, ExtendsNode) and
+                not node.parent_name.filters and
+                not isinstance(node.parent_name.var, Variable)):
+            parent = engine.get_template(node.parent_name.var)
+            if not (_skeleton_safe(node.nodelist, engine) and
+                    _skeleton_safe(parent.nodelist, engine)):
+                return False
+        else:
+            return False
+    return True
+
+
+class EmailTemplate:
+    """
+    An email template compiled once, with the static chrome pre-rendered into
+    a skeleton. Rendering only resolves the per-recipient variables and joins
+    them into the skeleton.
+
+    Templates that could use per-recipient variables in tags or filters
+    don't survive the skeleton pass, so those are always rendered in full.
+    """
+    def __init__(self, template_name):
+        self.template = get_template(template_name)
+        template = self.template.template
+        self.use_skeleton = _skeleton_safe(template.nodelist, template.engine)
+        if not self.use_skeleton:
+            return
+        skeleton = self.template.render(dict(
+            {'settings': settings},
+            **{name: _Placeholder(name) for name in PER_RECIPIENT_VARIABLES}
+        ))
+        # alternating literal chunks and variable paths
+        self.parts = _MARKER_RE.split(skeleton)
+
+    def _fill(self, context) -> str:
+        context = Context(
+            context, autoescape=self.template.backend.engine.autoescape)
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            try:
+                value = Variable(parts[i]).resolve(context)
+            except VariableDoesNotExist:
+                value = ''
+            parts[i] = render_value_in_context(value, context)
+        return ''.join(parts)
+
+    def render(self, context) -> str:
+        if not self.use_skeleton:
+            return self.template.render(context)
+        return self._fill(context)
+
+
+@lru_cache(maxsize=None)
+def _get_cached_email_template(template_name) -> EmailTemplate:
+    return EmailTemplate(template_name)
+
+
+def get_email_template(template_name) -> EmailTemplate:
+    """
+    Return the compiled email template, cached for the life of the process
+    (except when DEBUG is on, so template edits show up immediately).
+    """
+    if settings.DEBUG:
+        return EmailTemplate(template_name)
+    return _get_cached_email_template(template_name)
+
+
+def render_email(template_name, context) -> str:
+    """
+    Render an email template. The context should contain the per-recipient
+    variables; settings are baked into the cached skeleton.
+    """
+    return get_email_template(template_name).render(
+        dict(context, settings=settings))
@@ -0,0 +1,100 @@
+import csv
+import datetime
+import json
+
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .conf import get_setting
+from .serializers import ValuesSerializer
+
+# content type of each export format
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def parse_since(value):
+    """
+    Parse a since= date or datetime, returning an aware datetime or None if
+    the value isn't valid.
+    """
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            return None
+        since = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def iter_chunks(queryset, columns, chunk_size=None):
+    """
+    Yield lists of .values() rows in primary key order, fetching each chunk
+    with a query starting where the last one ended. Only one chunk is in
+    memory at a time; unlike .iterator(), this holds on every database
+    driver.
+    """
+    chunk_size = chunk_size or get_setting('EXPORT_CHUNK_SIZE')
+    queryset = queryset.order_by('pk').values('pk', *columns)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1]['pk']
+
+
+def csv_cell(value):
+    """
+    A serialized value as a CSV cell. Text that a spreadsheet would read as
+    a formula is prefixed with a quote, so an exported name can't run one
+    on an admin's machine.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class Echo:
+    """A file-like object that returns what is written, for csv.writer."""
+    def write(self, value):
+        return value
+
+
+def export_users(queryset, serializer, export_format, chunk_size=None):
+    """
+    Yield the users in queryset, serialized with the fields of serializer,
+    as NDJSON or CSV text, a chunk of rows at a time.
+    """
+    values_serializer = ValuesSerializer(serializer)
+    chunks = iter_chunks(queryset, values_serializer.columns, chunk_size)
+    if export_format == 'ndjson':
+        encoder = JSONEncoder()
+        for chunk in chunks:
+            yield ''.join(encoder.encode(item) + '\n' for item in
+                          values_serializer.to_representation(chunk))
+    elif export_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(
+            [name for name, column, func in values_serializer.fields])
+        for chunk in chunks:
+            yield ''.join(writer.writerow([
+                csv_cell(value) for value in item.values()])
+                for item in values_serializer.to_representation(chunk))
+    else:
+        raise ValueError('Unknown export format {!r}'.format(export_format))
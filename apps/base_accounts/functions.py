@@ -0,0 +1,27 @@
+from django.db.models import Func, IntegerField
+
+
+class Age(Func):
+    """
+    Whole years between a date expression and today, computed by the
+    database so it can be sorted and filtered on.
+    """
+    # MySQL; Postgres and SQLite have their own SQL below
+    template = 'TIMESTAMPDIFF(YEAR, %(expressions)s, CURDATE())'
+
+    def __init__(self, expression, **extra):
+        super().__init__(expression, output_field=IntegerField(), **extra)
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(
+            compiler, connection,
+            template="date_part('year', age(%(expressions)s))::integer")
+
+    def as_sqlite(self, compiler, connection):
+        # %%%% survives both the template and the backend's param formatting
+        template = (
+            "(CAST(strftime('%%%%Y', 'now') AS INTEGER)"
+            " - CAST(strftime('%%%%Y', %(expressions)s) AS INTEGER)"
+            " - (strftime('%%%%m-%%%%d', 'now')"
+            " < strftime('%%%%m-%%%%d', %(expressions)s)))")
+        return self.as_sql(compiler, connection, template=template)
@@ -0,0 +1,121 @@
+import io
+import multiprocessing
+import os
+import sys
+from concurrent.futures import Future
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .conf import get_setting
+
+# Pillow format and file extension of each variant format
+VARIANT_FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+}
+
+
+def get_variant_name(name, size, image_format):
+    """
+    The storage name of a variant of an uploaded image, stored next to it:
+    images/ab/ab12...ef.png -> images/ab/ab12...ef_80.webp
+    """
+    root, ext = os.path.splitext(name)
+    return '{}_{}{}'.format(root, size, VARIANT_FORMATS[image_format][1])
+
+
+def get_variant_size(size):
+    """The smallest variant size at least `size` pixels, or the largest."""
+    sizes = sorted(get_setting('IMAGE_VARIANT_SIZES'))
+    for variant_size in sizes:
+        if variant_size >= size:
+            return variant_size
+    return sizes[-1]
+
+
+def render_variants(data, sizes, formats, quality):
+    """
+    Render square, center-cropped variants of an image.
+
+    Returns a {(size, format): bytes} dict. This is CPU bound and doesn't
+    touch Django, so it can run in a worker process.
+    """
+    variants = {}
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        for size in sizes:
+            resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            for image_format in formats:
+                variant = resized
+                if image_format == 'jpeg' and variant.mode == 'RGBA':
+                    # JPEG has no alpha channel, flatten onto white
+                    variant = Image.new('RGB', resized.size, (255, 255, 255))
+                    variant.paste(resized, mask=resized.split()[3])
+                buffer = io.BytesIO()
+                variant.save(buffer, VARIANT_FORMATS[image_format][0],
+                             quality=quality)
+                variants[size, image_format] = buffer.getvalue()
+    return variants
+
+
+class SpawnedProcessPool:
+    """
+    A process pool with the submit() of an executor, whose processes are
+    spawned rather than forked. Forking a process that runs other threads,
+    as uWSGI workers with enable-threads do, copies locks those threads
+    hold, which can hang the children.
+    """
+    def __init__(self, processes):
+        context = multiprocessing.get_context('spawn')
+        if not os.path.basename(sys.executable).startswith('python'):
+            # under uWSGI, sys.executable is the uwsgi binary
+            context.set_executable(
+                os.path.join(sys.exec_prefix, 'bin', 'python3'))
+        self.pool = context.Pool(processes)
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        self.pool.apply_async(fn, args, callback=future.set_result,
+                              error_callback=future.set_exception)
+        return future
+
+
+def create_variants(storage, name, executor=None):
+    """
+    Render the variants of the stored image `name` and save them next to it.
+    Rendering is submitted to `executor` (e.g. a process pool) when one is
+    given, and skipped when the variants of this content already exist.
+    """
+    sizes = get_setting('IMAGE_VARIANT_SIZES')
+    formats = get_setting('IMAGE_VARIANT_FORMATS')
+    if all(storage.exists(get_variant_name(name, size, image_format))
+           for size in sizes for image_format in formats):
+        return
+    with storage.open(name) as image_file:
+        data = image_file.read()
+    args = (data, sizes, formats, get_setting('IMAGE_VARIANT_QUALITY'))
+    if executor is None:
+        variants = render_variants(*args)
+    else:
+        variants = executor.submit(render_variants, *args).result()
+    for (size, image_format), content in variants.items():
+        storage.save(get_variant_name(name, size, image_format),
+                     ContentFile(content))
+
+
+def get_variant_urls(storage, name, processed):
+    """
+    A {size: {format: url}} dict of the variants of an uploaded image. Until
+    the variants have been processed, every entry points at the original.
+    """
+    urls = {}
+    original_url = None if processed else storage.url(name)
+    for size in get_setting('IMAGE_VARIANT_SIZES'):
+        urls[str(size)] = {
+            image_format: original_url or storage.url(
+                get_variant_name(name, size, image_format))
+            for image_format in get_setting('IMAGE_VARIANT_FORMATS')}
+    return urls
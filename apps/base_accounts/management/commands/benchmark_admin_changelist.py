@@ -0,0 +1,92 @@
+import datetime
+import random
+import time
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from apps.base_accounts.admin import EmailUserAdmin
+
+
+class BaselineEmailUserAdmin(EmailUserAdmin):
+    """The changelist as it was before the age annotation and tuning."""
+    list_filter = ()
+    paginator = Paginator
+    show_full_result_count = True
+
+    def get_changelist(self, request, **kwargs):
+        return super(EmailUserAdmin, self).get_changelist(request, **kwargs)
+
+    def age(self, obj):
+        return obj.age
+
+
+class Command(BaseCommand):
+    help = ('Time the admin user changelist against a large user table. '
+            'Test users are created in a transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000,
+                            help='Number of users to create.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Requests per page, the best is reported.')
+
+    def handle(self, *args, **options):
+        model = get_user_model()
+        admin_user = model(email='benchmark-admin@example.com',
+                           is_superuser=True)
+        cases = [
+            ('default', {}),
+            ('sort by age', {'o': '7'}),
+            ('age 25-34', {'age': '25-34'}),
+            ('search', {'q': 'user123'}),
+        ]
+        with transaction.atomic():
+            self.create_users(model, options['users'])
+            for label, model_admin in (
+                    ('baseline', BaselineEmailUserAdmin(model, admin.site)),
+                    ('tuned', EmailUserAdmin(model, admin.site))):
+                for case, params in cases:
+                    if label == 'baseline' and case in ('sort by age',
+                                                        'age 25-34'):
+                        continue  # not supported before
+                    elapsed, queries = self.time_changelist(
+                        model_admin, admin_user, params, options['repeat'])
+                    self.stdout.write('{:<9} {:<12} {:8.1f} ms {:3} queries'
+                                      .format(label, case, elapsed * 1000,
+                                              queries))
+            transaction.set_rollback(True)
+
+    def create_users(self, model, count):
+        start = time.perf_counter()
+        today = datetime.date.today()
+        batch_size = 5000
+        for offset in range(0, count, batch_size):
+            model.objects.bulk_create([
+                model(email='user{}@example.com'.format(i),
+                      first_name='First{}'.format(i),
+                      last_name='Last{}'.format(i),
+                      birthdate=today - datetime.timedelta(
+                          days=random.randint(0, 90 * 365)))
+                for i in range(offset, min(offset + batch_size, count))
+            ])
+        self.stdout.write('Created {} users in {:.1f}s'.format(
+            count, time.perf_counter() - start))
+
+    def time_changelist(self, model_admin, user, params, repeat):
+        best = None
+        for _ in range(repeat):
+            request = RequestFactory().get(
+                '/admin/accounts/emailuser/', params, HTTP_HOST='localhost')
+            request.user = user
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                model_admin.changelist_view(request).render()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(queries)
@@ -0,0 +1,54 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.test.utils import override_settings
+
+from apps.base_accounts.emails import render_email
+
+TEMPLATES = (
+    'email/user_validation.html',
+    'email/user_validation.txt',
+    'email/user_validated.html',
+    'email/user_reset_password.html',
+    'email/user_reset_password_success.html',
+)
+
+
+class Command(BaseCommand):
+    help = ('Compare account email rendering throughput of render_to_string '
+            'and the cached skeleton renderer.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=2000,
+                            help='Number of renders per template.')
+
+    # DEBUG disables the template cache, so benchmark production behaviour
+    @override_settings(DEBUG=False)
+    def handle(self, *args, **options):
+        count = options['count']
+        user = get_user_model()(
+            email='benchmark@example.com', first_name='Bench')
+
+        def render_to_string_path(name, url):
+            return render_to_string(
+                name, {'settings': settings, 'user': user, 'url': url})
+
+        def skeleton_path(name, url):
+            return render_email(name, {'user': user, 'url': url})
+
+        for label, render in (('render_to_string', render_to_string_path),
+                              ('skeleton', skeleton_path)):
+            render(TEMPLATES[0], '')  # warm up caches
+            start = time.perf_counter()
+            for i in range(count):
+                url = 'https://example.com/validate/{}/'.format(i)
+                for name in TEMPLATES:
+                    render(name, url)
+            elapsed = time.perf_counter() - start
+            renders = count * len(TEMPLATES)
+            self.stdout.write('{:<18} {:>8} renders in {:6.2f}s '
+                              '({:,.0f} renders/s)'.format(
+                                  label, renders, elapsed, renders / elapsed))
@@ -0,0 +1,90 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.views import obtain_auth_token
+
+
+class Command(BaseCommand):
+    help = ('Replay a credential stuffing attack against /api-token-auth/ '
+            'with and without the login failure guard, and report the CPU '
+            'time it costs a worker. The target users are created in a '
+            'transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='Attack requests per run.')
+        parser.add_argument('--ips', type=int, default=10,
+                            help='Addresses the attack comes from.')
+        parser.add_argument('--emails', type=int, default=50,
+                            help='Accounts the attack targets.')
+
+    def handle(self, *args, **options):
+        self.factory = APIRequestFactory()
+        model = get_user_model()
+        radius = getattr(settings, 'radius', {})
+        unguarded = dict(radius, ACCOUNTS=dict(
+            radius.get('ACCOUNTS', {}),
+            LOGIN_MAX_FAILURES_PER_IP=float('inf'),
+            LOGIN_MAX_FAILURES_PER_EMAIL=float('inf')))
+
+        self.stdout.write(
+            'Limits: {} failures per IP, {} per email in {}s'.format(
+                get_setting('LOGIN_MAX_FAILURES_PER_IP'),
+                get_setting('LOGIN_MAX_FAILURES_PER_EMAIL'),
+                get_setting('LOGIN_FAILURE_WINDOW')))
+        with transaction.atomic():
+            # new addresses and accounts each run, so counters left in the
+            # cache by earlier runs don't count
+            run = uuid.uuid4().hex[:8]
+            emails = {
+                network: ['target{}-{}-{}@example.com'.format(i, network, run)
+                          for i in range(options['emails'])]
+                for network in (1, 2)}
+            bystander = 'bystander-{}@example.com'.format(run)
+            for email in emails[1] + emails[2] + [bystander]:
+                model.objects.create_user(
+                    email, 'correct horse', validated_at=timezone.now())
+            with override_settings(radius=unguarded):
+                self.attack('unguarded', emails[1], 1, options)
+            self.attack('guarded', emails[2], 2, options)
+
+            # other users aren't locked out by the attack
+            response = self.login(bystander, 'correct horse', '198.19.0.1')
+            self.stdout.write('Login by a user who was not attacked: {}'
+                              .format(response.status_code))
+            transaction.set_rollback(True)
+
+    def login(self, email, password, ip):
+        request = self.factory.post('/api-token-auth/', {
+            'username': email, 'password': password}, REMOTE_ADDR=ip)
+        return obtain_auth_token(request)
+
+    def attack(self, label, emails, network, options):
+        statuses = {}
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for i in range(options['requests']):
+            # 198.18.0.0/15 is reserved for benchmarks
+            ip = '198.18.{}.{}'.format(network, i % options['ips'] + 1)
+            response = self.login(emails[i % len(emails)], 'guess{}'.format(i),
+                                  ip)
+            statuses[response.status_code] = \
+                statuses.get(response.status_code, 0) + 1
+        cpu = time.process_time() - cpu_start
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            '{:<9} {} requests in {:.1f}s: {} checked passwords (401), {} '
+            'turned away (429); {:.2f} ms CPU per request, {:.0f} '
+            'requests/s per worker'.format(
+                label, options['requests'], elapsed, statuses.get(401, 0),
+                statuses.get(429, 0), cpu / options['requests'] * 1000,
+                options['requests'] / cpu if cpu else 0))
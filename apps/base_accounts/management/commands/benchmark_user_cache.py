@@ -0,0 +1,83 @@
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.accounts.views import UserViewSet
+from apps.base_accounts.caching import user_data_stats
+
+
+class Command(BaseCommand):
+    help = ('Time user detail requests with and without the user data '
+            'cache, picking users with a skewed distribution as real '
+            'traffic does. Test users are created in a transaction that is '
+            'rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Number of users to create.')
+        parser.add_argument('--requests', type=int, default=10000,
+                            help='Requests per run.')
+
+    def handle(self, *args, **options):
+        model = get_user_model()
+        self.factory = APIRequestFactory()
+        self.view = UserViewSet.as_view({'get': 'retrieve'})
+        self.admin = model(email='benchmark-admin@example.com',
+                           is_superuser=True)
+        radius = getattr(settings, 'radius', {})
+        uncached = dict(radius, ACCOUNTS=dict(
+            radius.get('ACCOUNTS', {}), USER_DATA_CACHE_TTL=0))
+
+        with transaction.atomic():
+            pks = [user.pk for user in model.objects.bulk_create(
+                model(email='bench{}@example.com'.format(i),
+                      first_name='Bench', last_name=str(i),
+                      image='images/00/bench{}.png'.format(i))
+                for i in range(options['users']))]
+            # the n-th most popular user is requested about 1/n as often
+            weights = [1 / (rank + 1) for rank in range(len(pks))]
+            requested = random.choices(pks, weights, k=options['requests'])
+            with override_settings(radius=uncached):
+                self.run('uncached', requested)
+            self.run('cached', requested)
+            transaction.set_rollback(True)
+
+    def run(self, label, pks):
+        timings = {True: [], False: []}
+        queries = 0
+        for pk in pks:
+            request = self.factory.get(
+                '/api/users/{}/'.format(pk), HTTP_HOST='localhost')
+            force_authenticate(request, self.admin)
+            hits = user_data_stats['hits']
+            # CaptureQueriesContext miscounts once the log is full
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                self.view(request, pk=str(pk)).render()
+                elapsed = time.perf_counter() - start
+            timings[user_data_stats['hits'] > hits].append(elapsed)
+            queries += len(captured)
+
+        self.stdout.write('{:<8} {} requests, {:.1%} hits, {:.2f} '
+                          'queries/request, {}'.format(
+                              label, len(pks), len(timings[True]) / len(pks),
+                              queries / len(pks),
+                              self.describe(timings[True] + timings[False])))
+        for hit in (True, False):
+            if timings[hit] and timings[not hit]:
+                self.stdout.write('  {:<6} {}'.format(
+                    'hits' if hit else 'misses', self.describe(timings[hit])))
+
+    def describe(self, timings):
+        timings = sorted(timings)
+        return 'mean {:.2f} ms, p50 {:.2f} ms, p95 {:.2f} ms'.format(
+            sum(timings) / len(timings) * 1000,
+            timings[len(timings) // 2] * 1000,
+            timings[int(len(timings) * 0.95)] * 1000)
@@ -0,0 +1,56 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.base_accounts.serializers import UserSerializer, ValuesSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compare the per-row cost of serializing the user list with '
+            'UserSerializer and with the .values() fast path. Test users are '
+            'created in a transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000,
+                            help='Number of users to serialize.')
+        parser.add_argument('--fields',
+                            help='Comma separated ?fields= projection.')
+
+    def handle(self, *args, **options):
+        query = {'fields': options['fields']} if options['fields'] else {}
+        request = Request(APIRequestFactory().get(
+            '/api/users/', query, HTTP_HOST='localhost'))
+        context = {'request': request}
+
+        with transaction.atomic():
+            model = get_user_model()
+            model.objects.bulk_create(
+                model(email='bench{}@example.com'.format(i),
+                      first_name='Bench', last_name=str(i),
+                      image='users/bench{}/profile.png'.format(i))
+                for i in range(options['users']))
+            queryset = model.objects.all()
+
+            def model_serializer():
+                return UserSerializer(
+                    queryset.all(), many=True, context=context).data
+
+            def values_serializer():
+                serializer = ValuesSerializer(
+                    UserSerializer(context=context))
+                return serializer.to_representation(
+                    queryset.values(*serializer.columns))
+
+            for label, serialize in (('UserSerializer', model_serializer),
+                                     ('ValuesSerializer', values_serializer)):
+                start = time.perf_counter()
+                rows = len(serialize())
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    '{:<18} {} rows in {:6.3f}s ({:6.1f} us/row)'.format(
+                        label, rows, elapsed, elapsed / rows * 1e6))
+            transaction.set_rollback(True)
@@ -0,0 +1,143 @@
+import os
+import re
+import shutil
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.images import VARIANT_FORMATS
+
+
+class Command(BaseCommand):
+    help = ('Delete, or move to a quarantine directory, user image files '
+            'under MEDIA_ROOT that no user references.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the orphans.')
+        parser.add_argument(
+            '--quarantine', metavar='DIR',
+            help='Move orphans into DIR instead of deleting them.')
+        parser.add_argument(
+            '--min-age', type=float, default=24,
+            help='Hours since a file was last modified before it can be '
+                 'collected, which protects uploads in progress.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Files checked per database query.')
+        parser.add_argument(
+            'directories', nargs='*', default=['images', 'users'],
+            help='Directories under MEDIA_ROOT to collect from.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.manager = get_user_model()._default_manager
+        # the storage name of a variant, capturing its original's root
+        self.variant_pattern = re.compile(r'^(.*)_({})({})$'.format(
+            '|'.join(str(size) for size in get_setting('IMAGE_VARIANT_SIZES')),
+            '|'.join(re.escape(ext) for pillow_format, ext
+                     in VARIANT_FORMATS.values())))
+        self.cutoff = time.time() - options['min_age'] * 60 * 60
+        self.counts = {'scanned': 0, 'orphans': 0, 'bytes': 0}
+        self.start = self.last_report = time.perf_counter()
+
+        for directory in options['directories']:
+            if os.path.isdir(os.path.join(settings.MEDIA_ROOT, directory)):
+                self.collect(directory, top=True)
+
+        self.stdout.write(self.style.SUCCESS('Done.'))
+        self.report()
+
+    def collect(self, directory, top=False):
+        """
+        Collect the orphans of a directory and its subdirectories. Variants
+        are stored next to their original, so only the file entries of one
+        directory are held in memory at a time.
+        """
+        entries = []
+        with os.scandir(os.path.join(settings.MEDIA_ROOT, directory)) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self.collect(os.path.join(directory, entry.name))
+                elif entry.is_file(follow_symlinks=False):
+                    entries.append(entry)
+        if not entries:
+            return
+        collected = self.collect_files(directory, entries)
+        if collected == len(entries) and not top and \
+                not self.options['dry_run']:
+            try:
+                # remove directories we emptied, e.g. users/<email>/
+                os.rmdir(os.path.join(settings.MEDIA_ROOT, directory))
+            except OSError:
+                pass
+
+    def collect_files(self, directory, entries):
+        """Collect the orphans among files, returning how many there were."""
+        # storage names always use forward slashes
+        prefix = '/'.join(os.path.normpath(directory).split(os.sep)) + '/'
+        batch_size = self.options['batch_size']
+
+        referenced = set()
+        for i in range(0, len(entries), batch_size):
+            names = [prefix + entry.name for entry in entries[i:i + batch_size]]
+            referenced.update(self.manager.filter(image__in=names)
+                              .values_list('image', flat=True))
+        referenced_roots = {os.path.splitext(name)[0] for name in referenced}
+
+        orphans = []
+        collected = 0
+        for entry in entries:
+            name = prefix + entry.name
+            if name in referenced:
+                continue
+            match = self.variant_pattern.match(name)
+            if match and match.group(1) in referenced_roots:
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime > self.cutoff:
+                continue
+            orphans.append((entry.path, name, stat.st_size))
+            collected += 1
+            if len(orphans) >= batch_size:
+                self.remove(orphans)
+                orphans = []
+        self.remove(orphans)
+        self.counts['scanned'] += len(entries)
+        if time.perf_counter() - self.last_report > 5:
+            self.report()
+        return collected
+
+    def remove(self, orphans):
+        """Delete or quarantine a batch of (path, name, size) orphans."""
+        quarantine = self.options['quarantine']
+        for path, name, size in orphans:
+            if self.options['verbosity'] > 1:
+                self.stdout.write(name)
+            if self.options['dry_run']:
+                pass
+            elif quarantine:
+                destination = os.path.join(quarantine, *name.split('/'))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.move(path, destination)
+            else:
+                os.remove(path)
+            self.counts['orphans'] += 1
+            self.counts['bytes'] += size
+
+    def report(self):
+        self.last_report = time.perf_counter()
+        elapsed = self.last_report - self.start
+        self.stdout.write(
+            '{} files scanned, {} orphans ({:.1f} MB){} in {:.1f}s, '
+            '{:.0f} files/s'.format(
+                self.counts['scanned'], self.counts['orphans'],
+                self.counts['bytes'] / 1024 / 1024,
+                ' found' if self.options['dry_run'] else (
+                    ' quarantined' if self.options['quarantine']
+                    else ' deleted'),
+                elapsed, self.counts['scanned'] / elapsed if elapsed else 0))
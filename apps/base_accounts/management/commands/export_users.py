@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.export import EXPORT_FORMATS, export_users, \
+    parse_since
+from apps.base_accounts.serializers import UserSerializer
+
+
+class Command(BaseCommand):
+    help = ('Export users as NDJSON or CSV, with the fields of the user API. '
+            'Users are read in chunks, so memory use does not grow with the '
+            'number of users.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', dest='export_format', choices=sorted(EXPORT_FORMATS),
+            default='ndjson')
+        parser.add_argument(
+            '--since',
+            help='Only export users who joined since this date or datetime.')
+        parser.add_argument(
+            '--output', '-o',
+            help='File to write to. Defaults to standard output.')
+        parser.add_argument(
+            '--chunk-size', type=int,
+            default=get_setting('EXPORT_CHUNK_SIZE'),
+            help='Users fetched per query.')
+
+    def handle(self, *args, **options):
+        queryset = get_user_model()._default_manager.all()
+        if options['since']:
+            since = parse_since(options['since'])
+            if since is None:
+                raise CommandError('--since must be a date or datetime')
+            queryset = queryset.filter(date_joined__gte=since)
+        lines = export_users(queryset, UserSerializer(),
+                             options['export_format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for chunk in lines:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,90 @@
+import operator
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.models import probe_gravatar
+
+
+class Command(BaseCommand):
+    help = ('Look up gravatar existence for users with a stale or missing '
+            'cached result, and store the results.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Probe every user, not just those with stale results.')
+        parser.add_argument(
+            '--concurrency', type=int, default=32,
+            help='Maximum number of requests in flight.')
+        parser.add_argument(
+            '--timeout', type=float, default=get_setting('GRAVATAR_TIMEOUT'),
+            help='Seconds to wait for each request.')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of users to probe between database writes.')
+        parser.add_argument(
+            '--base-url',
+            help='Gravatar base URL, e.g. a local stub server for testing.')
+
+    def handle(self, *args, **options):
+        manager = get_user_model()._default_manager
+        users = manager.all() if options['all'] else manager.gravatar_stale()
+        probe = partial(probe_gravatar, timeout=options['timeout'],
+                        base_url=options['base_url'])
+        counts = {True: 0, False: 0, None: 0}
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for batch in self.iter_batches(users, options['batch_size']):
+                results = dict(zip(
+                    batch, pool.map(probe, (email for pk, email in batch))))
+                self.save_results(manager, results)
+                for result in results.values():
+                    counts[result] += 1
+                self.report(counts, start)
+
+        self.stdout.write(self.style.SUCCESS('Done.'))
+        self.report(counts, start)
+
+    def iter_batches(self, users, batch_size):
+        """Yield lists of (pk, email), paging through users by primary key."""
+        users = users.order_by('pk').values_list('pk', 'email')
+        last_pk = None
+        while True:
+            page = users if last_pk is None else users.filter(pk__gt=last_pk)
+            batch = list(page[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1][0]
+
+    def save_results(self, manager, results):
+        """
+        Write results, by (pk, email), with one UPDATE per outcome. Errors
+        aren't stored, nor are results for users whose email has changed
+        since. The gravatar fields aren't serialized, so updated_at stays.
+        """
+        now = timezone.now()
+        for found in (True, False):
+            users = [Q(pk=pk, email=email)
+                     for (pk, email), result in results.items()
+                     if result is found]
+            if users:
+                manager.filter(reduce(operator.or_, users)).update(
+                    has_gravatar=found, gravatar_checked_at=now)
+
+    def report(self, counts, start):
+        total = sum(counts.values())
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            '{} probed ({} found, {} missing, {} errors) in {:.1f}s, '
+            '{:.1f} users/s'.format(
+                total, counts[True], counts[False], counts[None], elapsed,
+                total / elapsed if elapsed else 0))
@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apps.base_accounts.conf import get_setting
+
+
+def process_image(user, executor):
+    try:
+        return user.process_image(executor=executor)
+    finally:
+        # this runs on a pool thread with its own connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = ('Render the sized variants of uploaded profile images that '
+            'have not been processed yet.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Re-render every uploaded image, e.g. after changing sizes.')
+        parser.add_argument(
+            '--workers', type=int,
+            default=get_setting('IMAGE_PROCESS_WORKERS'),
+            help='Number of worker processes.')
+
+    def handle(self, *args, **options):
+        users = get_user_model()._default_manager.exclude(image='').exclude(
+            image__isnull=True).only('pk', 'image', 'image_processed_at')
+        if not options['all']:
+            users = users.filter(image_processed_at__isnull=True)
+        workers = options['workers']
+        processed = failed = 0
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=workers) as processes, \
+                ThreadPoolExecutor(max_workers=workers) as threads:
+            futures = [(user, threads.submit(process_image, user, processes))
+                       for user in users.iterator()]
+            for user, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write('{}: {}'.format(user.image.name, e))
+                else:
+                    processed += 1
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            '{} images processed, {} failed in {:.1f}s ({:.1f} images/s)'
+            .format(processed, failed, elapsed,
+                    processed / elapsed if elapsed else 0)))
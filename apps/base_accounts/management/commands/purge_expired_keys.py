@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.models import UserKey
+
+
+class Command(BaseCommand):
+    help = 'Delete expired validation and password reset keys in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=get_setting('EXPIRED_KEY_PURGE_BATCH_SIZE'),
+            help='Number of keys to delete per query.')
+
+    def handle(self, *args, **options):
+        deleted = 0
+        while True:
+            # short DELETEs keep locks brief on a busy table
+            pks = list(UserKey.objects.expired().values_list(
+                'pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+            UserKey.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+        self.stdout.write('Deleted {} expired keys.'.format(deleted))
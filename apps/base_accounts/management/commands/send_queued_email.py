@@ -0,0 +1,93 @@
+import logging
+import smtplib
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from apps.base_accounts.conf import get_setting
+from apps.base_accounts.models import QueuedEmail
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Send emails waiting in the outbox, retrying failures with backoff.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=get_setting('OUTBOX_BATCH_SIZE'),
+            help='Number of emails to send per batch.')
+        parser.add_argument(
+            '--interval', type=float,
+            default=get_setting('OUTBOX_POLL_INTERVAL'),
+            help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the outbox is empty instead of polling.')
+
+    def handle(self, *args, **options):
+        # consecutive failures to reach the mail server
+        outages = 0
+        while True:
+            try:
+                sent, failed = self.send_batch(options['batch_size'])
+            except (OSError, smtplib.SMTPException) as err:
+                if options['once']:
+                    raise CommandError(
+                        'Could not connect to the mail server: {!r}'.format(
+                            err))
+                outages += 1
+                # back off like a failed email, but without using up the
+                # attempts of the emails in the batch
+                delay = min(
+                    get_setting('OUTBOX_RETRY_DELAY') * 2 ** (outages - 1),
+                    get_setting('OUTBOX_MAX_RETRY_DELAY'))
+                logger.exception('Could not connect to the mail server, '
+                                 'retrying in %ss', delay)
+                time.sleep(delay)
+                continue
+            outages = 0
+            if sent or failed:
+                self.stdout.write('Sent {}, failed {}'.format(sent, failed))
+                continue
+            if options['once']:
+                return
+            time.sleep(options['interval'])
+
+    def send_batch(self, batch_size):
+        """
+        Lock a batch of due emails and send them over a single connection.
+        Returns a (sent, failed) tuple, or raises if the mail server can't
+        be reached, leaving the batch as it was.
+        """
+        sent = failed = 0
+        with transaction.atomic():
+            batch = list(
+                QueuedEmail.objects.pending().select_for_update()
+                .order_by('send_after')[:batch_size])
+            if not batch:
+                return sent, failed
+            connection = get_connection()
+            connection.open()
+            try:
+                for email in batch:
+                    email.attempts += 1
+                    try:
+                        email.get_message(connection).send()
+                    except Exception as err:
+                        email.last_error = repr(err)
+                        email.send_after = (
+                            timezone.now() + email.get_retry_delay())
+                        failed += 1
+                    else:
+                        email.sent_at = timezone.now()
+                        sent += 1
+                    email.save(update_fields=[
+                        'attempts', 'sent_at', 'send_after', 'last_error'])
+            finally:
+                connection.close()
+        return sent, failed
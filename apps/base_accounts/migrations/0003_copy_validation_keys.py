@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.db import migrations
+from django.utils import timezone
+
+
+def copy_validation_keys(apps, schema_editor):
+    """
+    Move outstanding user.validation_key values into hashed UserKey rows, so
+    links that were already emailed keep working until they expire.
+    Unvalidated users get validation keys, everyone else reset keys.
+    """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    UserKey = apps.get_model('base_accounts', 'UserKey')
+    now = timezone.now()
+    users = User.objects.filter(validation_key__isnull=False).values_list(
+        'pk', 'validation_key', 'validated_at')
+    keys = []
+    for pk, key, validated_at in users.iterator():
+        if validated_at is None:
+            purpose, ttl = 'validation', datetime.timedelta(days=30)
+        else:
+            purpose, ttl = 'reset-password', datetime.timedelta(days=1)
+        keys.append(UserKey(
+            user_id=pk, purpose=purpose,
+            key_hash=hashlib.sha256(str(key).encode('utf-8')).hexdigest(),
+            expires_at=now + ttl))
+    UserKey.objects.bulk_create(keys, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('base_accounts', '0002_userkey'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_validation_keys, migrations.RunPython.noop),
+    ]
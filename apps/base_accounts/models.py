@@ -1,7 +1,9 @@
 import datetime
 import os
+import threading
 import uuid
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode
@@ -11,12 +13,20 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, \
     PermissionsMixin
 from django.core.mail import send_mail, EmailMultiAlternatives
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_token, invalidate_user_token
+from .caching import invalidate_user_data
+from .conf import get_setting
+from .emails import render_email
+from .images import SpawnedProcessPool, create_variants, get_variant_name, \
+    get_variant_size
+from .storage import ContentAddressedStorage, get_content_hash
 
 
 def get_placeholder_url(request=None) -> str:
@@ -41,8 +51,11 @@ def get_placeholder_url(request=None) -> str:
     return url
 
 
-def get_gravatar_url(email, size=80, secure=True, default='mm'):
-    if secure:
+def get_gravatar_url(email, size=80, secure=True, default='mm',
+                     base_url=None):
+    if base_url:
+        url_base = base_url
+    elif secure:
         url_base = 'https://secure.gravatar.com/'
     else:
         url_base = 'http://www.gravatar.com/'
@@ -56,24 +69,204 @@ def get_gravatar_url(email, size=80, secure=True, default='mm'):
     return url
 
 
-def has_gravatar(email):
-    url = get_gravatar_url(email, default='404')
+def probe_gravatar(email, timeout=None, base_url=None):
+    """
+    Returns True if the email has a gravatar, False if it doesn't, or None
+    if gravatar couldn't be reached.
+    """
+    url = get_gravatar_url(email, default='404', base_url=base_url)
     try:
         request = Request(url)
         request.get_method = lambda: 'HEAD'
-        return 200 == urlopen(request).code
-    except (HTTPError, URLError):
-        return False
+        return 200 == urlopen(
+            request, timeout=timeout or get_setting('GRAVATAR_TIMEOUT')).code
+    except HTTPError as err:
+        return False if err.code == 404 else None
+    except (URLError, OSError):
+        return None
+
+
+def has_gravatar(email, timeout=None):
+    return bool(probe_gravatar(email, timeout=timeout))
+
+
+_gravatar_executor = None
+_gravatar_refreshes = set()
+_gravatar_lock = threading.Lock()
+
+
+def _refresh_gravatar(user):
+    try:
+        user.refresh_gravatar()
+    finally:
+        with _gravatar_lock:
+            _gravatar_refreshes.discard(user.pk)
+        # this runs on an executor thread with its own connection
+        connection.close()
+
+
+_image_executor = None
+_image_process_pool = None
+_image_lock = threading.Lock()
+
+
+def _process_image(user):
+    try:
+        user.process_image(executor=_image_process_pool)
+    finally:
+        # this runs on an executor thread with its own connection
+        connection.close()
 
 
 def user_image_upload_to(user, filename):
-    """Upload images to a sensible location."""
-    ext = os.path.splitext(filename)[-1]
+    """
+    Name images after the hash of their content, so identical images are
+    stored once and a name always refers to the same bytes (which lets
+    them be cached forever).
+    """
+    ext = os.path.splitext(filename)[-1].lower()
     if filename == 'blob':
         ext = '.png'
-    return 'users/{}/profile{}'.format(
-        user.email, ext
-    )
+    content_hash = get_content_hash(user.image.file)
+    return 'images/{}/{}{}'.format(content_hash[:2], content_hash, ext)
+
+
+class QueuedEmailQuerySet(models.QuerySet):
+    def pending(self):
+        """Emails that are due to be sent and have attempts left."""
+        return self.filter(
+            sent_at__isnull=True,
+            send_after__lte=timezone.now(),
+            attempts__lt=get_setting('OUTBOX_MAX_ATTEMPTS'),
+        )
+
+
+class QueuedEmail(models.Model):
+    """
+    An email waiting in the outbox. Rows are drained by the
+    send_queued_email management command, so sending mail never blocks a
+    request.
+    """
+    to_email = models.EmailField()
+    from_email = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255)
+    body_text = models.TextField()
+    body_html = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(default=timezone.now)
+    send_after = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = QueuedEmailQuerySet.as_manager()
+
+    class Meta:
+        index_together = [('sent_at', 'send_after')]
+
+    def __str__(self):
+        return '{} to {}'.format(self.subject, self.to_email)
+
+    @classmethod
+    def enqueue_many(cls, emails):
+        """
+        Add unsaved emails to the outbox with a single INSERT once the
+        current transaction commits, so emails are never queued for changes
+        that were rolled back.
+        """
+        transaction.on_commit(lambda: cls.objects.bulk_create(emails))
+
+    def get_message(self, connection=None) -> EmailMultiAlternatives:
+        msg = EmailMultiAlternatives(
+            subject=self.subject, body=self.body_text,
+            from_email=self.from_email, to=[self.to_email],
+            connection=connection)
+        if self.body_html:
+            msg.attach_alternative(self.body_html, 'text/html')
+        return msg
+
+    def get_retry_delay(self) -> datetime.timedelta:
+        """Exponential backoff based on the number of failed attempts."""
+        delay = get_setting('OUTBOX_RETRY_DELAY') * 2 ** (self.attempts - 1)
+        delay = min(delay, get_setting('OUTBOX_MAX_RETRY_DELAY'))
+        return datetime.timedelta(seconds=delay)
+
+
+class UserKeyQuerySet(models.QuerySet):
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
+
+
+class UserKey(models.Model):
+    """
+    A single-use key emailed to a user to validate their account or reset
+    their password. Only a hash of the key is stored, and keys expire.
+    """
+    VALIDATION = 'validation'
+    RESET_PASSWORD = 'reset-password'
+    PURPOSE_CHOICES = [
+        (VALIDATION, 'Account validation'),
+        (RESET_PASSWORD, 'Password reset'),
+    ]
+    TTL_SETTINGS = {
+        VALIDATION: 'VALIDATION_KEY_TTL',
+        RESET_PASSWORD: 'RESET_PASSWORD_KEY_TTL',
+    }
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        related_name='keys')
+    purpose = models.CharField(max_length=16, choices=PURPOSE_CHOICES)
+    key_hash = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = UserKeyQuerySet.as_manager()
+
+    def __str__(self):
+        return '{} key for {}'.format(self.purpose, self.user_id)
+
+    @staticmethod
+    def hash_key(key) -> str:
+        return hashlib.sha256(str(key).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def issue(cls, user, purpose) -> str:
+        """
+        Create a key for the user, replacing any earlier key for the same
+        purpose, and return the raw key to put in the emailed link.
+        """
+        return cls.issue_many([user], purpose)[user.pk]
+
+    @classmethod
+    def issue_many(cls, users, purpose) -> dict:
+        """
+        Like issue(), for many users at once. Returns {user pk: raw key}.
+        """
+        keys = {user.pk: str(uuid.uuid4()) for user in users}
+        cls.objects.filter(user__in=list(keys), purpose=purpose).delete()
+        ttl = get_setting(cls.TTL_SETTINGS[purpose])
+        expires_at = timezone.now() + datetime.timedelta(seconds=ttl)
+        cls.objects.bulk_create([
+            cls(user_id=pk, purpose=purpose, key_hash=cls.hash_key(key),
+                expires_at=expires_at)
+            for pk, key in keys.items()])
+        return keys
+
+    @classmethod
+    def get_user(cls, key, purpose):
+        """
+        Return the user for an unexpired key, or None. This is a single
+        probe of the key_hash index.
+        """
+        user_key = cls.objects.select_related('user').filter(
+            key_hash=cls.hash_key(key), purpose=purpose,
+            expires_at__gt=timezone.now()).first()
+        return user_key.user if user_key else None
+
+    @classmethod
+    def revoke(cls, user, purpose) -> None:
+        cls.objects.filter(user=user, purpose=purpose).delete()
 
 
 class EmailUserManager(BaseUserManager):
@@ -90,6 +283,20 @@ class EmailUserManager(BaseUserManager):
     def create_superuser(self, email, password, **kwargs):
         return self._create_user(email, password, is_superuser=True, **kwargs)
 
+    def gravatar_stale(self):
+        """Users whose cached gravatar lookup is missing or expired."""
+        now = timezone.now()
+        hit_cutoff = now - datetime.timedelta(
+            seconds=get_setting('GRAVATAR_TTL'))
+        miss_cutoff = now - datetime.timedelta(
+            seconds=get_setting('GRAVATAR_NEGATIVE_TTL'))
+        return self.get_queryset().filter(
+            models.Q(has_gravatar__isnull=True) |
+            models.Q(gravatar_checked_at__isnull=True) |
+            models.Q(has_gravatar=True, gravatar_checked_at__lt=hit_cutoff) |
+            models.Q(has_gravatar=False, gravatar_checked_at__lt=miss_cutoff)
+        )
+
 
 class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
     GENDER_CHOICES = [
@@ -105,20 +312,34 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
     first_name = models.CharField(_('first name'), max_length=30, blank=True)
     last_name = models.CharField(_('last name'), max_length=30, blank=True)
     image = models.ImageField(
-        upload_to=user_image_upload_to, blank=True, null=True)
+        upload_to=user_image_upload_to, storage=ContentAddressedStorage(),
+        blank=True, null=True)
     preferred_name = models.CharField(max_length=30, blank=True)
     gender = models.CharField(
         null=True, blank=True, max_length=1, choices=GENDER_CHOICES,
         default=None)
     birthdate = models.DateField(
-        null=True, blank=True, verbose_name='Birth date')
+        null=True, blank=True, db_index=True, verbose_name='Birth date')
     phone = models.CharField(
         max_length=16, blank=True, verbose_name='Phone number')
 
+    # When the variants of the uploaded image were rendered
+    image_processed_at = models.DateTimeField(
+        null=True, blank=True, editable=False)
+
+    # Cached result of the gravatar lookup, refreshed off the request path
+    has_gravatar = models.NullBooleanField(editable=False)
+    gravatar_checked_at = models.DateTimeField(
+        null=True, blank=True, editable=False)
+
     # Account Validation
     date_joined = models.DateTimeField(_('date joined'), default=timezone.now)
     validated_at = models.DateTimeField(null=True, blank=True)
-    validation_key = models.UUIDField(default=uuid.uuid4, null=True, blank=True)
+
+    # When anything in the user's API representation last changed; set by
+    # save() and by every .update() of serialized fields, it versions the
+    # responses
+    updated_at = models.DateTimeField(auto_now=True)
 
     # Permissions
     is_developer = models.BooleanField(
@@ -131,9 +352,40 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
         abstract = True
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        # backs the keyset pagination of the user list
+        index_together = [('date_joined', 'id')]
 
     objects = EmailUserManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored email so save() can tell when it changes
+        instance._loaded_email = instance.__dict__.get('email')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # auto_now only reaches the database if it's among update_fields
+        changed_fields = {'updated_at'}
+        loaded_email = getattr(self, '_loaded_email', None)
+        if loaded_email and self.__dict__.get('email') != loaded_email:
+            # the cached gravatar lookup belongs to the old address
+            self.has_gravatar = None
+            self.gravatar_checked_at = None
+            changed_fields |= {'has_gravatar', 'gravatar_checked_at'}
+        new_image = bool(self.image) and not self.image._committed
+        if (new_image or not self.image) and self.image_processed_at:
+            # the variants belong to the old image
+            self.image_processed_at = None
+            changed_fields.add('image_processed_at')
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = (
+                set(kwargs['update_fields']) | changed_fields)
+        super().save(*args, **kwargs)
+        self._loaded_email = self.__dict__.get('email')
+        if new_image:
+            transaction.on_commit(self.schedule_image_processing)
+
     # Core Django Functionality
     def get_full_name(self):
         """Returns first_name plus last_name, with a space in between."""
@@ -157,48 +409,136 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
     def age(self) -> int:
         """
         Returns the person's age in years, or zero if there is no
-        birthdate.
+        birthdate. The Age database function computes the same value.
         """
         if not self.birthdate:
             return 0
-        # TODO: make this calculation better
-        # noinspection PyTypeChecker
-        return (datetime.date.today() - self.birthdate).days // 365
+        today = datetime.date.today()
+        had_birthday = ((today.month, today.day) >=
+                        (self.birthdate.month, self.birthdate.day))
+        return today.year - self.birthdate.year - (not had_birthday)
 
-    def _send_html_mail(self, subject, template_html, template_text, **context):
+    def _render_html_mail(self, subject, template_html, template_text,
+                          **context) -> QueuedEmail:
         """
-        Renders templates to context, and uses EmailMultiAlternatives to
-        send email.
+        Renders the cached email templates to context, returning an unsaved
+        email for the outbox.
         """
         if not template_html:
             raise ValueError('No HTML template provided for email.')
         if not template_text:
             raise ValueError('No text template provided for email.')
         default_context = {
-            "settings": settings,
             "user": self
         }
         default_context.update(context)
-        from_email = settings.DEFAULT_FROM_EMAIL
-        body_text = render_to_string(template_text, default_context)
-        body_html = render_to_string(template_html, default_context)
+        return QueuedEmail(
+            to_email=self.email, from_email=settings.DEFAULT_FROM_EMAIL,
+            subject=subject,
+            body_text=render_email(template_text, default_context),
+            body_html=render_email(template_html, default_context))
 
-        msg = EmailMultiAlternatives(
-            subject=subject, body=body_text,
-            from_email=from_email, to=[self.email])
-        msg.attach_alternative(body_html, 'text/html')
-        msg.send()
+    def _send_html_mail(self, subject, template_html, template_text, **context):
+        """
+        Renders the cached email templates to context, and queues the email
+        in the outbox.
+        """
+        QueuedEmail.enqueue_many([self._render_html_mail(
+            subject, template_html, template_text, **context)])
+
+    # Gravatar lookups
+    @property
+    def gravatar_is_stale(self) -> bool:
+        """
+        Whether the cached gravatar lookup is missing or older than its TTL.
+        Misses are cached for a shorter time than hits.
+        """
+        if self.has_gravatar is None or not self.gravatar_checked_at:
+            return True
+        ttl = get_setting(
+            'GRAVATAR_TTL' if self.has_gravatar else 'GRAVATAR_NEGATIVE_TTL')
+        age = timezone.now() - self.gravatar_checked_at
+        return age > datetime.timedelta(seconds=ttl)
+
+    def refresh_gravatar(self) -> bool:
+        """
+        Look up whether this user has a gravatar, and store the result.
+        This does network I/O, so keep it off the request path.
+        """
+        self.has_gravatar = has_gravatar(self.email)
+        self.gravatar_checked_at = timezone.now()
+        # neither field is serialized, so the user's responses and their
+        # version (updated_at) stay as they are
+        type(self)._default_manager.filter(pk=self.pk, email=self.email).update(
+            has_gravatar=self.has_gravatar,
+            gravatar_checked_at=self.gravatar_checked_at)
+        return self.has_gravatar
+
+    def schedule_gravatar_refresh(self) -> None:
+        """Refresh the cached gravatar lookup on a background thread."""
+        global _gravatar_executor
+        with _gravatar_lock:
+            if self.pk in _gravatar_refreshes:
+                return
+            _gravatar_refreshes.add(self.pk)
+            if _gravatar_executor is None:
+                _gravatar_executor = ThreadPoolExecutor(max_workers=2)
+        _gravatar_executor.submit(_refresh_gravatar, self)
+
+    # Profile image variants
+    def process_image(self, executor=None) -> bool:
+        """
+        Render and store the fixed-size variants of the uploaded image.
+        This is CPU heavy, so keep it off the request path. Returns False if
+        there's no image, or it was replaced while rendering.
+        """
+        name = self.image.name
+        if not name:
+            return False
+        create_variants(self.image.storage, name, executor=executor)
+        self.image_processed_at = self.updated_at = timezone.now()
+        updated = type(self)._default_manager.filter(
+            pk=self.pk, image=name).update(
+                image_processed_at=self.image_processed_at,
+                updated_at=self.updated_at)
+        # image_urls now point at the variants
+        invalidate_user_data(self.pk)
+        return bool(updated)
+
+    def schedule_image_processing(self) -> None:
+        """
+        Render the image variants in the background. Resizing runs in a
+        process pool, so it doesn't hold the GIL of the serving process.
+        """
+        global _image_executor, _image_process_pool
+        with _image_lock:
+            if _image_executor is None:
+                workers = get_setting('IMAGE_PROCESS_WORKERS')
+                _image_process_pool = SpawnedProcessPool(workers)
+                _image_executor = ThreadPoolExecutor(max_workers=workers)
+        _image_executor.submit(_process_image, self)
 
     # Get the profile pic
-    def get_image_url(self, request=None) -> str:
+    def get_image_url(self, request=None, size=None,
+                      image_format='jpeg') -> str:
         """
         Get the profile image url for this user if it exists.
-        If not, return either their gravatar url or the placeholder image url.
+        If not, return either their gravatar url or the placeholder image url,
+        based on the cached gravatar lookup. Stale lookups are served as-is
+        and refreshed in the background.
+
+        Pass a size in pixels to get the smallest variant at least that big
+        (the original is used until the variants have been processed).
         """
         if not self.image:
-            if has_gravatar(self.email):
-                return get_gravatar_url(self.email, size=256)
+            if self.pk and self.gravatar_is_stale:
+                self.schedule_gravatar_refresh()
+            if self.has_gravatar:
+                return get_gravatar_url(self.email, size=size or 256)
             return get_placeholder_url(request=request)
+        elif size and self.image_processed_at:
+            url = self.image.storage.url(get_variant_name(
+                self.image.name, get_variant_size(size), image_format))
         else:
             url = self.image.url
         if request:
@@ -207,17 +547,18 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
 
     def image_tag(self) -> str:
         """Returns html tag with user image. Used on admin page"""
-        return '<img src="{}"  height="20"/>'.format(self.get_image_url())
+        return '<img src="{}"  height="20"/>'.format(
+            self.get_image_url(size=20))
     image_tag.short_description = 'Thumbnail'
     image_tag.allow_tags = True
 
     # Set the user as active
     def validate(self) -> None:
         """
-        Marks a user as validated and sends a confirmation email, clearing the
-        validation_key so the validation link only works once.
+        Marks a user as validated and sends a confirmation email, revoking the
+        validation key so the validation link only works once.
         """
-        self.validation_key = None
+        UserKey.revoke(self, UserKey.VALIDATION)
         self.validated_at = timezone.now()
         self.save()
         self._send_html_mail(
@@ -227,39 +568,50 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
 
     def send_validation_email(self):
         """
-        Send email with a unique link using validation_key to validate account.
+        Send email with a unique link using a validation key to validate
+        account.
         """
-        self.validation_key = uuid.uuid4()
-        self.save()
-        self._send_html_mail(
+        key = UserKey.issue(self, UserKey.VALIDATION)
+        QueuedEmail.enqueue_many([self._render_validation_email(key)])
+
+    @classmethod
+    def send_validation_emails(cls, users):
+        """
+        Send validation emails to many users, with one query for their keys
+        and one for the emails.
+        """
+        keys = UserKey.issue_many(users, UserKey.VALIDATION)
+        QueuedEmail.enqueue_many([
+            user._render_validation_email(keys[user.pk]) for user in users])
+
+    def _render_validation_email(self, key) -> QueuedEmail:
+        return self._render_html_mail(
             'You have requested access to Benefit Sculptor',
             'email/user_validation.html',
             'email/user_validation.txt',
             url=settings.SITE_DOMAIN + reverse(
                 'user-validation',
-                kwargs={"validation_key": self.validation_key})
+                kwargs={"validation_key": key})
         )
 
     def send_reset_password_email(self, request):
         """
         Send email with unique link to reset password. Create a new
-        validation_key, which will be cleared once password is reset.
+        reset key, which will be revoked once password is reset.
         """
-        self.validation_key = uuid.uuid4()
-        self.save()
+        key = UserKey.issue(self, UserKey.RESET_PASSWORD)
         self._send_html_mail(
             'Password Reset Request',
             'email/user_reset_password.html',
             'email/user_reset_password.txt',
-            url=settings.SITE_DOMAIN_WEB + '/login/reset-password;validation_key={}'.format(self.validation_key))
+            url=settings.SITE_DOMAIN_WEB + '/login/reset-password;validation_key={}'.format(key))
 
     def send_reset_password_success_email(self):
         """
         Send email notifying users that their password was successfully reset.
-        Validation key is cleared so the reset password link only works once.
+        Reset key is revoked so the reset password link only works once.
         """
-        self.validation_key = None
-        self.save()
+        UserKey.revoke(self, UserKey.RESET_PASSWORD)
         self._send_html_mail(
             'Password successfully changed',
             'email/user_reset_password_success.html',
@@ -271,3 +623,26 @@ def validate_new_user(sender, instance, created, **kwargs):
     """Send a validation email when a new user is created."""
     if created and not instance.validated_at:
         instance.send_validation_email()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user_token(sender, instance, **kwargs):
+    """Drop the cached token so token auth picks up the user's changes."""
+    invalidate_user_token(instance.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user_data(sender, instance, **kwargs):
+    """
+    Drop the user's cached API representations once the change is committed,
+    so they can't be cached again from a read of the old row.
+    """
+    pk = instance.pk
+    transaction.on_commit(lambda: invalidate_user_data(pk))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
@@ -0,0 +1,197 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, namedtuple
+from urllib import parse
+from uuid import UUID
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, \
+    _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .conf import get_setting
+
+Cursor = namedtuple('Cursor', ['reverse', 'date_joined', 'pk'])
+
+
+def _get_position(row):
+    """The (date_joined, id) of a user instance or a .values() row."""
+    if isinstance(row, dict):
+        return row['date_joined'], row['id']
+    return row.date_joined, row.pk
+
+
+class UserCursorPagination(BasePagination):
+    """
+    Opt-in keyset pagination for users, ordered on (date_joined, id).
+
+    Responses are only paginated when the client passes a page_size or
+    cursor, so existing clients keep getting a plain list. Cursors are
+    opaque and hold the position of the last row seen, so pages stay stable
+    while users sign up and no COUNT(*) is needed.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor.reverse
+
+        if reverse:
+            queryset = queryset.order_by('-date_joined', '-id')
+        else:
+            queryset = queryset.order_by('date_joined', 'id')
+
+        if cursor is not None:
+            # (date_joined, id) > (cursor position), spelled out since Django
+            # can't compare rows; the plain bound on date_joined lets the
+            # (date_joined, id) index start at the cursor
+            lookup = 'lt' if reverse else 'gt'
+            queryset = queryset.filter(
+                Q(**{'date_joined__' + lookup + 'e': cursor.date_joined}),
+                Q(**{'date_joined__' + lookup: cursor.date_joined}) |
+                Q(date_joined=cursor.date_joined,
+                  **{'id__' + lookup: cursor.pk}))
+
+        # fetch an extra row to find out whether there is another page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+
+        # a reverse cursor always comes from a later page
+        if reverse:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, cursor is not None
+
+        self.next_cursor = self.previous_cursor = None
+        if self.page and has_next:
+            self.next_cursor = Cursor(False, *_get_position(self.page[-1]))
+        if self.page and has_previous:
+            self.previous_cursor = Cursor(True, *_get_position(self.page[0]))
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.encode_cursor(self.next_cursor)),
+            ('previous', self.encode_cursor(self.previous_cursor)),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        params = request.query_params
+        if self.page_size_query_param in params:
+            try:
+                return _positive_int(
+                    params[self.page_size_query_param], strict=True,
+                    cutoff=get_setting('USER_MAX_PAGE_SIZE'))
+            except (KeyError, ValueError):
+                pass
+        if self.cursor_query_param in params:
+            return get_setting('USER_PAGE_SIZE')
+        return None
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            querystring = urlsafe_b64decode(encoded.encode('ascii'))
+            tokens = parse.parse_qs(querystring.decode('ascii'))
+            date_joined = parse_datetime(tokens['d'][0])
+            pk = UUID(tokens['i'][0])
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if date_joined is None:
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(reverse, date_joined, pk)
+
+    def encode_cursor(self, cursor):
+        if cursor is None:
+            return None
+        tokens = {'d': cursor.date_joined.isoformat(), 'i': str(cursor.pk)}
+        if cursor.reverse:
+            tokens['r'] = '1'
+        querystring = parse.urlencode(tokens)
+        encoded = urlsafe_b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded)
+
+
+def estimate_count(queryset):
+    """
+    The Postgres planner's estimate of the number of rows in a queryset, or
+    None when there is no estimate (other databases, never analyzed tables).
+
+    Unfiltered querysets use the table statistics in pg_class.reltuples,
+    filtered ones the row estimate of the query plan.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            # reltuples is -1 (or 0 on old versions) until the first ANALYZE
+            if row is None or row[0] <= 0:
+                return None
+            return int(row[0])
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that trusts the planner's estimate for large querysets
+    instead of running an exact COUNT(*), which scans the whole table on
+    Postgres. Below ESTIMATED_COUNT_THRESHOLD rows, and on other databases,
+    the count is exact.
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return len(queryset)
+        estimate = estimate_count(queryset)
+        if (estimate is not None and
+                estimate >= get_setting('ESTIMATED_COUNT_THRESHOLD')):
+            return estimate
+        # Counting primary keys stops annotations from being computed (and
+        # grouped by) for every row.
+        return queryset.values('pk').count()
+
+
+class EstimatedCountPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination, enabled by ?page_size=, that estimates the total
+    count of large querysets.
+    """
+    django_paginator_class = EstimatedCountPaginator
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return get_setting('USER_MAX_PAGE_SIZE')
@@ -0,0 +1,30 @@
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections
+from django.db.models import Q
+from django.db.models.functions import Greatest
+
+# Each of these has a trigram index on UPPER(column), which is what Django's
+# icontains lookup compiles to on Postgres; see the accounts migrations.
+SEARCH_FIELDS = ('email', 'first_name', 'last_name', 'preferred_name')
+
+
+def search_users(queryset, query):
+    """
+    Filters users to those where every whitespace separated term of the
+    query is found in one of SEARCH_FIELDS, like the admin search.
+
+    On Postgres the terms are matched through trigram indexes, and results
+    are ranked by their best trigram similarity to the whole query, which is
+    annotated as search_rank.
+    """
+    for term in query.split():
+        term_filter = Q()
+        for field in SEARCH_FIELDS:
+            term_filter |= Q(**{field + '__icontains': term})
+        queryset = queryset.filter(term_filter)
+
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.order_by('email')
+    return queryset.annotate(search_rank=Greatest(*[
+        TrigramSimilarity(field, query) for field in SEARCH_FIELDS
+    ])).order_by('-search_rank', 'email')
@@ -1,5 +1,28 @@
+from collections import OrderedDict
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+from .images import get_variant_urls
+
+
+def get_requested_fields(request, field_names):
+    """
+    Returns the subset of field_names selected by the ?fields= or ?omit=
+    query parameters (comma separated), or None if neither was passed.
+    """
+    if request is None:
+        return None
+    params = request.query_params
+    if 'fields' in params:
+        requested = set(params['fields'].split(','))
+        return [name for name in field_names if name in requested]
+    if 'omit' in params:
+        omitted = set(params['omit'].split(','))
+        return [name for name in field_names if name not in omitted]
+    return None
 
 
 class SettingsUserForSerializers:
@@ -9,6 +32,131 @@ class SettingsUserForSerializers:
         super().__init__(*args, **kwargs)
 
 
+class SparseFieldsMixin:
+    """
+    Lets clients pick the fields they need with ?fields=a,b or ?omit=a,b.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = get_requested_fields(
+            self.context.get('request'), list(self.fields))
+        if requested is not None:
+            for name in set(self.fields) - set(requested):
+                self.fields.pop(name)
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """
+    URLs of the uploaded profile image variants as {size: {format: url}},
+    or None when there's no uploaded image.
+    """
+    # the columns ValuesSerializer passes to from_values()
+    value_columns = ('image', 'image_processed_at')
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_representation(self, user):
+        return self.from_values(user.image.name, user.image_processed_at)
+
+    def from_values(self, image, image_processed_at):
+        if not image:
+            return None
+        storage = self.parent.Meta.model._meta.get_field('image').storage
+        urls = get_variant_urls(storage, image, image_processed_at is not None)
+        request = self.context.get('request')
+        if request is not None:
+            for formats in urls.values():
+                for image_format, url in formats.items():
+                    formats[image_format] = request.build_absolute_uri(url)
+        return urls
+
+
+class ValuesSerializer:
+    """
+    Read-only serialization of QuerySet.values() rows, using the fields of a
+    ModelSerializer instance. This skips model instantiation and DRF's
+    per-field attribute lookups, which dominate the cost of large lists.
+
+    Only serializers whose readable fields all map directly onto concrete
+    model columns, or declare the value_columns they are computed from, are
+    supported; check with ValuesSerializer.supports().
+    """
+    def __init__(self, serializer):
+        self.fields = []
+        self.columns = []
+        model = serializer.Meta.model
+        request = serializer.context.get('request')
+        for field in serializer._readable_fields:
+            value_columns = getattr(field, 'value_columns', None)
+            if value_columns is not None:
+                # computed from several columns, gets the whole row
+                self.fields.append((field.field_name, None, self._from_values(
+                    field, value_columns)))
+                self.columns.extend(value_columns)
+                continue
+            model_field = model._meta.get_field(field.source)
+            if isinstance(field, serializers.FileField):
+                to_representation = self._file_url(
+                    model_field.storage, field, request)
+            else:
+                to_representation = field.to_representation
+            self.fields.append(
+                (field.field_name, model_field.attname, to_representation))
+            self.columns.append(model_field.attname)
+
+    @classmethod
+    def supports(cls, serializer) -> bool:
+        model = serializer.Meta.model
+        for field in serializer._readable_fields:
+            if hasattr(field, 'value_columns'):
+                continue
+            if field.source == '*' or '.' in field.source:
+                return False
+            try:
+                model_field = model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                return False
+            if not model_field.concrete or model_field.many_to_many:
+                return False
+        return True
+
+    @staticmethod
+    def _from_values(field, columns):
+        return lambda row: field.from_values(*(row[column]
+                                               for column in columns))
+
+    @staticmethod
+    def _file_url(storage, field, request):
+        if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+            return lambda name: name or None
+
+        def to_representation(name):
+            if not name:
+                return None
+            url = storage.url(name)
+            if request is not None:
+                return request.build_absolute_uri(url)
+            return url
+        return to_representation
+
+    def to_representation(self, rows):
+        fields = self.fields
+        data = []
+        for row in rows:
+            item = OrderedDict()
+            for name, column, to_representation in fields:
+                if column is None:
+                    item[name] = to_representation(row)
+                    continue
+                value = row[column]
+                item[name] = (
+                    None if value is None else to_representation(value))
+            data.append(item)
+        return data
+
+
 class CreateUserSerializer(SettingsUserForSerializers,
                            serializers.ModelSerializer):
     def create(self, validated_data):
@@ -23,17 +171,20 @@ class CreateUserSerializer(SettingsUserForSerializers,
         read_only_fields = ('date_joined', 'last_login',
                             'is_developer', )
         exclude = ('is_superuser', 'groups', 'user_permissions',
-                   'validation_key', 'validated_at', )
+                   'validated_at', 'has_gravatar',
+                   'gravatar_checked_at', 'image_processed_at', )
         extra_kwargs = {'password': {'write_only': True}}
 
 
-class UserSerializer(SettingsUserForSerializers,
+class UserSerializer(SparseFieldsMixin, SettingsUserForSerializers,
                      serializers.ModelSerializer):
-    # TODO image url instead of file
+    image_urls = ImageVariantsField()
+
     class Meta:
         # the model attribute will be set by
         # SettingsUserForSerializers.__init__() - see that method
         read_only_fields = ('email', 'date_joined', 'last_login',
                             'is_developer', )
         exclude = ('password', 'is_superuser', 'groups', 'user_permissions',
-                   'validation_key', 'validated_at')
\ No newline at end of file
+                   'validated_at', 'has_gravatar',
+                   'gravatar_checked_at', 'image_processed_at')
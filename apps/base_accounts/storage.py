@@ -0,0 +1,60 @@
+import errno
+import hashlib
+import os
+import threading
+
+from django.core.files.storage import FileSystemStorage
+
+# Cache-Control for files whose name is derived from their content
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_content_hash(content):
+    """
+    The sha256 hex digest of an uploaded file. Files received through
+    HashingFileUploadHandler were hashed while streaming in; anything else
+    is read in chunks.
+    """
+    content_hash = getattr(content, 'content_hash', None)
+    if content_hash is None:
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        content_hash = digest.hexdigest()
+    return content_hash
+
+
+# set while ContentAddressedStorage._save() runs in this thread
+_saving = threading.local()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage for files named after their content hash. A file
+    that already exists under a name has the same content, so saving it
+    again is skipped rather than stored under a new name.
+    """
+    def get_available_name(self, name, max_length=None):
+        if getattr(_saving, 'active', False):
+            # FileSystemStorage._save() found the file created since our
+            # exists() check and asks for another name; there is none
+            raise FileExistsError(errno.EEXIST, 'File exists', name)
+        return name
+
+    def _save(self, name, content):
+        if not self.exists(name):
+            _saving.active = True
+            try:
+                return super()._save(name, content)
+            except OSError:
+                # another worker saved the same content first; moving a
+                # temporary file over it fails with a plain IOError
+                if not self.exists(name):
+                    raise
+            finally:
+                _saving.active = False
+        # mark the file as in use again, which protects it from being
+        # collected as an orphan (see collect_orphaned_media)
+        os.utime(self.path(name))
+        return name
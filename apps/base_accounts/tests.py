@@ -1,11 +1,44 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import datetime
+from io import StringIO
+from unittest import mock
 from urllib.parse import urlparse
 import requests
 from django.contrib.auth import get_user_model
-from django.test import Client
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, \
+    TemporaryUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.conf import settings
+from django.template import engines
+from django.template.loader import render_to_string
+from django.test import Client, SimpleTestCase, TestCase, \
+    TransactionTestCase, override_settings
+from django.utils import timezone
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
+from PIL import Image
 from rest_framework.reverse import reverse
 
-from .models import get_placeholder_url
+from .emails import EmailTemplate, render_email
+from .management.commands import probe_gravatars
+from .functions import Age
+from .images import SpawnedProcessPool
+from .models import get_gravatar_url, get_placeholder_url, QueuedEmail
+from .pagination import EstimatedCountPaginator
+from .serializers import UserSerializer
+from .storage import ContentAddressedStorage
+from .throttling import check_login_failures, clear_login_failures, \
+    record_login_failure
 
 
 class AccountsTestCase(StaticLiveServerTestCase):
@@ -51,4 +84,436 @@ class AccountsTestCase(StaticLiveServerTestCase):
         url = self.live_server_url + path
         # use a real HTTP request to get the image
         response = requests.get(url)
-        self.assertEqual(response.status_code, 200)
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)
+
+
+class EmailOutboxTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'outbox@example.com', 'password')
+
+    def test_validation_email_is_queued(self):
+        self.assertEqual(len(mail.outbox), 0)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.to_email, 'outbox@example.com')
+        self.assertIsNone(queued.sent_at)
+
+    def test_send_queued_email(self):
+        call_command('send_queued_email', once=True, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['outbox@example.com'])
+        queued = QueuedEmail.objects.get()
+        self.assertIsNotNone(queued.sent_at)
+        self.assertEqual(queued.attempts, 1)
+
+    def test_failed_email_is_retried_later(self):
+        with mock.patch('django.core.mail.EmailMessage.send',
+                        side_effect=OSError('SES unavailable')):
+            call_command('send_queued_email', once=True, stdout=StringIO())
+        queued = QueuedEmail.objects.get()
+        self.assertIsNone(queued.sent_at)
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn('SES unavailable', queued.last_error)
+        self.assertFalse(QueuedEmail.objects.pending().exists())
+
+    def test_mail_server_outage_backs_off(self):
+        """
+        The worker waits for an unreachable mail server without using up
+        the emails' attempts
+        """
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 3:
+                raise KeyboardInterrupt
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open',
+                        side_effect=[ConnectionRefusedError, OSError, None]), \
+                mock.patch('time.sleep', side_effect=sleep), \
+                mock.patch('apps.base_accounts.management.commands.'
+                           'send_queued_email.logger') as logger, \
+                self.assertRaises(KeyboardInterrupt):
+            call_command('send_queued_email', interval=5, stdout=StringIO())
+        self.assertEqual(delays, [60, 120, 5])
+        self.assertEqual(logger.exception.call_count, 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(QueuedEmail.objects.get().attempts, 1)
+
+        QueuedEmail.objects.update(sent_at=None)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open',
+                        side_effect=OSError), self.assertRaises(CommandError):
+            call_command('send_queued_email', once=True, stdout=StringIO())
+
+
+class EmailRenderingTestCase(SimpleTestCase):
+    def test_skeleton_matches_full_render(self):
+        user = get_user_model()(email='o\'brien@example.com', first_name='<b>')
+        context = {'user': user, 'url': 'https://example.com/?a=1&b=2'}
+        for name in ('email/user_validation.html', 'email/user_validation.txt',
+                     'email/user_validated.html',
+                     'email/user_reset_password.html',
+                     'email/user_reset_password_success.txt'):
+            expected = render_to_string(name, dict(context, settings=settings))
+            self.assertTrue(EmailTemplate(name).use_skeleton)
+            self.assertEqual(render_email(name, context), expected)
+
+    def test_data_dependent_template_is_rendered_in_full(self):
+        engine = engines['django']
+        users = [get_user_model()(email='a@example.com', first_name='Ann'),
+                 get_user_model()(email='b@example.com')]
+        for source in ('{% if user.first_name %}Hi {{ user.first_name }}'
+                       '{% else %}Hello{% endif %}',
+                       'Hi {{ user.first_name|default:"there" }}',
+                       'Hi {{ settings.EMAIL.LOGO_ALT|default:user.email }}'):
+            with mock.patch('apps.base_accounts.emails.get_template',
+                            return_value=engine.from_string(source)):
+                template = EmailTemplate('email/test.html')
+            self.assertFalse(template.use_skeleton)
+            for user in users:
+                context = {'user': user, 'settings': settings}
+                self.assertEqual(
+                    template.render(context),
+                    engine.from_string(source).render(context))
+
+
+@mock.patch('apps.base_accounts.models.urlopen')
+class GravatarCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'gravatar@example.com', 'password')
+
+    def test_unchecked_user_gets_placeholder(self, urlopen):
+        with mock.patch.object(get_user_model(),
+                               'schedule_gravatar_refresh') as schedule:
+            self.assertEqual(self.user.get_image_url(), get_placeholder_url())
+        schedule.assert_called_once_with()
+        urlopen.assert_not_called()
+
+    def test_cached_gravatar(self, urlopen):
+        get_user_model().objects.filter(pk=self.user.pk).update(
+            has_gravatar=True, gravatar_checked_at=timezone.now())
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertFalse(user.gravatar_is_stale)
+        self.assertEqual(user.get_image_url(),
+                         get_gravatar_url(user.email, size=256))
+        urlopen.assert_not_called()
+
+    def test_refresh_gravatar(self, urlopen):
+        urlopen.return_value.code = 200
+        self.assertTrue(self.user.refresh_gravatar())
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertTrue(user.has_gravatar)
+        self.assertIsNotNone(user.gravatar_checked_at)
+        # the API representation didn't change, nor did its version
+        self.assertEqual(user.updated_at, self.user.updated_at)
+
+    def test_email_change_clears_cache(self, urlopen):
+        get_user_model().objects.filter(pk=self.user.pk).update(
+            has_gravatar=True, gravatar_checked_at=timezone.now())
+        user = get_user_model().objects.get(pk=self.user.pk)
+        user.email = 'changed@example.com'
+        user.save(update_fields=['email'])
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertIsNone(user.has_gravatar)
+        self.assertTrue(user.gravatar_is_stale)
+
+
+class StubGravatarHandler(BaseHTTPRequestHandler):
+    found = set()
+
+    def do_HEAD(self):
+        email_hash = urlparse(self.path).path.split('/')[-1].split('.')[0]
+        self.send_response(200 if email_hash in self.found else 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ProbeGravatarsTestCase(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubGravatarHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        for i in range(10):
+            get_user_model().objects.create_user(
+                'user{}@example.com'.format(i), 'password')
+        StubGravatarHandler.found = {
+            hashlib.md5('user{}@example.com'.format(i).encode()).hexdigest()
+            for i in range(3)
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_probe_stale_users(self):
+        get_user_model().objects.filter(email='user9@example.com').update(
+            has_gravatar=False, gravatar_checked_at=timezone.now())
+        versions = dict(get_user_model().objects.values_list(
+            'pk', 'updated_at'))
+        out = StringIO()
+        call_command('probe_gravatars', base_url=self.base_url,
+                     batch_size=4, concurrency=4, stdout=out)
+        self.assertIn('9 probed (3 found, 6 missing, 0 errors)',
+                      out.getvalue())
+        users = get_user_model().objects
+        self.assertEqual(users.filter(has_gravatar=True).count(), 3)
+        self.assertEqual(users.filter(has_gravatar=False).count(), 7)
+        self.assertFalse(users.gravatar_stale().exists())
+        self.assertEqual(dict(users.values_list('pk', 'updated_at')),
+                         versions)
+
+    def test_changed_email_is_not_updated(self):
+        user = get_user_model().objects.get(email='user0@example.com')
+        get_user_model().objects.filter(pk=user.pk).update(
+            email='renamed@example.com')
+        probe_gravatars.Command().save_results(
+            get_user_model().objects, {(user.pk, 'user0@example.com'): True})
+        user = get_user_model().objects.get(pk=user.pk)
+        self.assertIsNone(user.has_gravatar)
+
+
+class AgeTestCase(TestCase):
+    def test_age_function_matches_property(self):
+        today = datetime.date.today()
+        birthdates = [
+            today.replace(year=today.year - 30),
+            today.replace(year=today.year - 30) + datetime.timedelta(days=1),
+            today.replace(year=today.year - 30) - datetime.timedelta(days=1),
+            datetime.date(1988, 2, 29),
+        ]
+        for i, birthdate in enumerate(birthdates):
+            get_user_model().objects.create_user(
+                'age{}@example.com'.format(i), birthdate=birthdate)
+        users = get_user_model().objects.annotate(age_years=Age('birthdate'))
+        for user in users:
+            self.assertEqual(user.age_years, user.age, user.birthdate)
+
+
+class EstimatedCountPaginatorTestCase(TestCase):
+    def setUp(self):
+        for i in range(3):
+            get_user_model().objects.create_user('count{}@example.com'.format(i))
+        self.users = get_user_model().objects.annotate(
+            age_years=Age('birthdate')).order_by('email')
+
+    def test_exact_count_without_estimate(self):
+        self.assertEqual(EstimatedCountPaginator(self.users, 2).count, 3)
+
+    @mock.patch.dict('apps.base_accounts.conf.DEFAULTS',
+                     {'ESTIMATED_COUNT_THRESHOLD': 1000})
+    def test_estimate_above_threshold(self):
+        with mock.patch('apps.base_accounts.pagination.estimate_count',
+                        return_value=5000):
+            paginator = EstimatedCountPaginator(self.users, 2)
+            self.assertEqual(paginator.count, 5000)
+            self.assertEqual(len(paginator.page(2).object_list), 1)
+        with mock.patch('apps.base_accounts.pagination.estimate_count',
+                        return_value=999):
+            self.assertEqual(EstimatedCountPaginator(self.users, 2).count, 3)
+
+
+def make_image_upload(size=(300, 200), mode='RGBA', name='me.png'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (200, 40, 40, 128)[:len(mode)]).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), 'image/png')
+
+
+class ImageVariantsTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = get_user_model().objects.create_user(
+            'image@example.com', 'password')
+        self.user.image = make_image_upload()
+        self.user.save()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_original_served_until_processed(self):
+        self.assertIsNone(self.user.image_processed_at)
+        self.assertEqual(self.user.get_image_url(size=80), self.user.image.url)
+        urls = UserSerializer(self.user).data['image_urls']
+        self.assertEqual(urls['80']['webp'], self.user.image.url)
+
+    def test_process_image(self):
+        self.assertTrue(self.user.process_image())
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertIsNotNone(user.image_processed_at)
+        storage = user.image.storage
+        for size in (20, 80, 256):
+            for image_format, extension in (('jpeg', '.jpg'),
+                                            ('webp', '.webp')):
+                name = user.image.name.replace(
+                    '.png', '_{}{}'.format(size, extension))
+                with Image.open(storage.path(name)) as variant:
+                    self.assertEqual(variant.size, (size, size))
+                    self.assertEqual(variant.format, image_format.upper())
+        # the smallest variant that is big enough
+        self.assertTrue(user.get_image_url(size=50).endswith('_80.jpg'))
+        self.assertTrue(user.get_image_url(
+            size=20, image_format='webp').endswith('_20.webp'))
+        self.assertEqual(user.get_image_url(), user.image.url)
+        urls = UserSerializer(user).data['image_urls']
+        self.assertEqual(urls['256']['jpeg'], user.get_image_url(size=256))
+
+    def test_process_image_in_spawned_pool(self):
+        pool = SpawnedProcessPool(1)
+        self.addCleanup(pool.pool.terminate)
+        self.assertTrue(self.user.process_image(executor=pool))
+        name = self.user.image.name.replace('.png', '_80.webp')
+        with Image.open(self.user.image.storage.path(name)) as variant:
+            self.assertEqual(variant.size, (80, 80))
+        with self.assertRaises(OSError):
+            pool.submit(Image.open, io.BytesIO(b'not an image')).result()
+
+    def test_new_upload_clears_variants(self):
+        self.user.process_image()
+        user = get_user_model().objects.get(pk=self.user.pk)
+        user.image = make_image_upload(mode='RGB')
+        user.save()
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertIsNone(user.image_processed_at)
+
+
+class ContentAddressedStorageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.storage = ContentAddressedStorage(location=self.media_root)
+
+    def test_concurrent_save_of_same_content(self):
+        name = 'images/ab/ab01.png'
+        path = self.storage.path(name)
+        exists = self.storage.exists
+
+        def saved_by_another_worker(check_name):
+            # the other worker creates the file right after our check
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(b'content')
+                os.utime(path, (0, 0))
+                return False
+            return exists(check_name)
+
+        with TemporaryUploadedFile('ab01.png', 'image/png', 7, None) as temp:
+            temp.write(b'content')
+            temp.flush()
+            for content in (ContentFile(b'content'), temp):
+                if os.path.exists(path):
+                    os.remove(path)
+                with mock.patch.object(self.storage, 'exists',
+                                       side_effect=saved_by_another_worker):
+                    self.assertEqual(self.storage.save(name, content), name)
+                self.assertEqual(os.listdir(os.path.dirname(path)),
+                                 ['ab01.png'])
+                self.assertGreater(os.path.getmtime(path), 0)
+
+
+class CollectOrphanedMediaTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        old = time.time() - 2 * 24 * 60 * 60
+        for name in ['images/ab/ab01.png', 'images/ab/ab01_80.webp',
+                     'images/ab/ab02.jpg', 'images/ab/ab02_20.jpg',
+                     'users/gone@example.com/profile.png',
+                     'users/kept@example.com/profile_8fj2k1a.png']:
+            self.create_file(name, mtime=old)
+        self.create_file('images/cd/cd03.png')  # too recent to collect
+        get_user_model().objects.create_user(
+            'one@example.com', image='images/ab/ab01.png')
+        get_user_model().objects.create_user(
+            'kept@example.com',
+            image='users/kept@example.com/profile_8fj2k1a.png')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def create_file(self, name, mtime=None):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 10)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def list_files(self, root):
+        return sorted(
+            os.path.relpath(os.path.join(path, name), root)
+            for path, dirs, files in os.walk(root) for name in files)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('collect_orphaned_media', dry_run=True, stdout=out)
+        self.assertEqual(len(self.list_files(self.media_root)), 7)
+        self.assertIn('7 files scanned, 3 orphans', out.getvalue())
+
+    def test_quarantine(self):
+        quarantine = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine)
+        call_command('collect_orphaned_media', quarantine=quarantine,
+                     stdout=StringIO())
+        self.assertEqual(self.list_files(quarantine), [
+            'images/ab/ab02.jpg', 'images/ab/ab02_20.jpg',
+            'users/gone@example.com/profile.png'])
+        self.assertEqual(self.list_files(self.media_root), [
+            'images/ab/ab01.png', 'images/ab/ab01_80.webp',
+            'images/cd/cd03.png',
+            'users/kept@example.com/profile_8fj2k1a.png'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.media_root, 'users/gone@example.com')))
+
+    def test_delete(self):
+        call_command('collect_orphaned_media', min_age=0, batch_size=2,
+                     stdout=StringIO())
+        self.assertEqual(self.list_files(self.media_root), [
+            'images/ab/ab01.png', 'images/ab/ab01_80.webp',
+            'users/kept@example.com/profile_8fj2k1a.png'])
+
+
+@mock.patch.dict('apps.base_accounts.conf.DEFAULTS', {
+    'LOGIN_FAILURE_WINDOW': 100,
+    'LOGIN_MAX_FAILURES_PER_IP': 10,
+    'LOGIN_MAX_FAILURES_PER_EMAIL': 4})
+class LoginFailureTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sliding_window(self):
+        # four failures halfway through a window block the email...
+        for _ in range(4):
+            record_login_failure('10.0.0.1', 'One@Example.com', now=1050)
+        self.assertIsNone(check_login_failures('10.0.0.1', None, now=1050))
+        wait = check_login_failures('10.0.0.2', 'one@example.com', now=1050)
+        # ...until they count for less than four during the next window
+        self.assertEqual(wait, 51)
+        self.assertIsNotNone(check_login_failures(
+            '10.0.0.2', 'one@example.com', now=1050 + wait - 1))
+        self.assertIsNone(check_login_failures(
+            '10.0.0.2', 'one@example.com', now=1050 + wait))
+        self.assertIsNone(check_login_failures(
+            '10.0.0.2', 'one@example.com', now=1300))
+
+    def test_ip_limit_and_clear(self):
+        for i in range(10):
+            record_login_failure('10.0.0.1', 'user{}@example.com'.format(i),
+                                 now=1000)
+        self.assertIsNotNone(check_login_failures(
+            '10.0.0.1', 'new@example.com', now=1000))
+        self.assertIsNone(check_login_failures(
+            '10.0.0.2', 'user1@example.com', now=1000))
+
+        for _ in range(4):
+            record_login_failure('10.0.0.2', 'one@example.com', now=1000)
+        clear_login_failures('one@example.com', now=1000)
+        self.assertIsNone(check_login_failures(
+            '10.0.0.3', 'one@example.com', now=1000))
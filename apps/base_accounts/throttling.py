@@ -0,0 +1,198 @@
+import hashlib
+import math
+import time
+
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+from .conf import get_setting
+
+LOGIN_FAILURES_CACHE_KEY = 'login-failures:{}:{}:{}'
+
+
+def get_client_ip(request):
+    """
+    The client's address, read from X-Forwarded-For when the
+    REST_FRAMEWORK['NUM_PROXIES'] setting says we are behind a proxy.
+    """
+    return BaseThrottle().get_ident(request)
+
+
+def _login_failure_counters(ip, email, now):
+    """
+    Yields (scope, limit, current key, previous key) for the IP and the
+    email of a login attempt, when given.
+
+    Failures are counted over a sliding window, approximated with two fixed
+    windows: the current one, and the previous one weighted by how much of
+    it the sliding window still overlaps. That is two small cache entries
+    per client however many attempts it makes.
+    """
+    window = get_setting('LOGIN_FAILURE_WINDOW')
+    index = int(now // window)
+    counters = []
+    if ip:
+        counters.append(('ip', ip, get_setting('LOGIN_MAX_FAILURES_PER_IP')))
+    if isinstance(email, str) and email.strip():
+        counters.append(('email', email.strip().lower(),
+                         get_setting('LOGIN_MAX_FAILURES_PER_EMAIL')))
+    for scope, ident, limit in counters:
+        # hashed, so any email makes a valid cache key
+        ident = hashlib.sha1(ident.encode()).hexdigest()
+        yield (scope, limit,
+               LOGIN_FAILURES_CACHE_KEY.format(scope, ident, index),
+               LOGIN_FAILURES_CACHE_KEY.format(scope, ident, index - 1))
+
+
+def _retry_after(current, previous, elapsed, limit, window):
+    """Seconds until the estimated failures drop below the limit."""
+    if current < limit:
+        # the previous window's share decays while this window passes
+        free_at = 1 - (limit - current) / previous
+    else:
+        # then this window's share decays during the next one
+        free_at = 2 - limit / current
+    return int((free_at - elapsed) * window) + 1
+
+
+def check_login_failures(ip, email, now=None):
+    """
+    Returns the number of seconds to wait if the client IP or the email has
+    failed to log in too often recently, otherwise None. This is a single
+    cache read, so check it before any password is hashed.
+    """
+    now = time.time() if now is None else now
+    window = get_setting('LOGIN_FAILURE_WINDOW')
+    elapsed = now % window / window
+    counters = list(_login_failure_counters(ip, email, now))
+    counts = cache.get_many([key for scope, limit, current, previous
+                             in counters for key in (current, previous)])
+    wait = None
+    for scope, limit, current, previous in counters:
+        current, previous = counts.get(current, 0), counts.get(previous, 0)
+        if previous * (1 - elapsed) + current >= limit:
+            wait = max(wait or 0, _retry_after(
+                current, previous, elapsed, limit, window))
+    return wait
+
+
+def record_login_failure(ip, email, now=None):
+    now = time.time() if now is None else now
+    # a counter must outlive the window after its own
+    timeout = 2 * get_setting('LOGIN_FAILURE_WINDOW')
+    for scope, limit, current, previous in _login_failure_counters(
+            ip, email, now):
+        cache.add(current, 0, timeout)
+        try:
+            cache.incr(current)
+        except ValueError:
+            # expired or evicted since the add
+            cache.set(current, 1, timeout)
+
+
+def clear_login_failures(email, now=None):
+    """Forgets the failures of an email, e.g. once its owner logs in."""
+    now = time.time() if now is None else now
+    for scope, limit, current, previous in _login_failure_counters(
+            None, email, now):
+        cache.delete_many([current, previous])
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    A token bucket throttle. A rate of "N/period" gives each bucket room for
+    N requests, refilled at N per period, so bursts are allowed but the
+    sustained rate isn't exceeded.
+
+    Like ScopedRateThrottle, it throttles views with a throttle_scope. The
+    rates come from the THROTTLE_RATES setting, by scope and then by the
+    kind of bucket; subclasses pick the bucket of a request.
+
+    Each bucket is a single float in the shared cache: the time it will be
+    full again (the "theoretical arrival time" of GCRA). Concurrent
+    requests can both read the old value, so a few extra requests may get
+    through under contention.
+    """
+    cache_format = 'throttle:%(scope)s:%(kind)s:%(ident)s'
+    kind = None
+
+    def __init__(self):
+        # the rate depends on the view, see allow_request()
+        pass
+
+    def get_rate(self):
+        return get_setting('THROTTLE_RATES').get(self.scope, {}).get(self.kind)
+
+    def get_bucket(self, request, view):
+        """The string identifying the request's bucket, or None."""
+        raise NotImplementedError('.get_bucket() must be overridden')
+
+    def get_cache_key(self, request, view):
+        bucket = self.get_bucket(request, view)
+        if bucket is None:
+            return None
+        return self.cache_format % {
+            'scope': self.scope,
+            'kind': self.kind,
+            # hashed, so any email makes a valid cache key
+            'ident': hashlib.sha1(bucket.encode()).hexdigest(),
+        }
+
+    def allow_request(self, request, view):
+        self.scope = getattr(view, 'throttle_scope', None)
+        self.rate = self.get_rate() if self.scope else None
+        if self.rate is None:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = self.timer()
+        interval = self.duration / self.num_requests
+        full_at = max(self.cache.get(self.key, now), now) + interval
+        # the request needs a token; it is refilled by full_at - duration
+        self.wait_time = full_at - self.duration - now
+        if self.wait_time > 0:
+            return False
+        self.cache.set(self.key, full_at, math.ceil(full_at - now))
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class IPThrottle(TokenBucketThrottle):
+    """A bucket per client address."""
+    kind = 'ip'
+
+    def get_bucket(self, request, view):
+        return get_client_ip(request)
+
+
+class EmailThrottle(TokenBucketThrottle):
+    """
+    A bucket per email the request targets: the view's email URL argument,
+    or the email in the request body.
+    """
+    kind = 'email'
+
+    def get_bucket(self, request, view):
+        email = view.kwargs.get('email')
+        if email is None and isinstance(request.data, dict):
+            email = request.data.get('email')
+        if not isinstance(email, str) or not email.strip():
+            return None
+        return email.strip().lower()
+
+
+class GlobalThrottle(TokenBucketThrottle):
+    """One bucket shared by every client, e.g. to protect a send quota."""
+    kind = 'global'
+
+    def get_bucket(self, request, view):
+        return 'all'
+
+
+# for views that send email to an address anyone can submit
+EMAIL_SENDING_THROTTLES = (IPThrottle, EmailThrottle, GlobalThrottle)
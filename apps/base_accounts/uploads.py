@@ -0,0 +1,54 @@
+import hashlib
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import MultiPartParser
+
+from .conf import get_setting
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = _('Upload too large.')
+
+
+class HashingFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams uploaded files to a temporary file on disk, never memory, and
+    hashes them on the way. The upload is rejected as soon as it goes over
+    IMAGE_UPLOAD_MAX_SIZE: before the body is read when the request
+    declares its length, otherwise when the limit is crossed.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_size = get_setting('IMAGE_UPLOAD_MAX_SIZE')
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        if content_length > self.max_size:
+            raise UploadTooLarge()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.content_hash = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            raise UploadTooLarge()
+        self.content_hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.content_hash = self.content_hash.hexdigest()
+        return file
+
+
+class HashingMultiPartParser(MultiPartParser):
+    """Parses multipart uploads with HashingFileUploadHandler."""
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        request.upload_handlers = [HashingFileUploadHandler(request._request)]
+        return super().parse(stream, media_type, parser_context)
@@ -1,22 +1,54 @@
+import hashlib
+
 from django.conf import settings
 from django import forms
 from django.contrib.auth import get_user_model
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, \
+    Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils.cache import get_conditional_response, \
+    patch_cache_control
+from django.utils.http import http_date, quote_etag, urlencode
 from django.views.generic import TemplateView
+from django.views.static import serve
 from django.views.decorators.cache import never_cache
-from rest_framework import status, views, viewsets
+from rest_framework import exceptions, generics, status, views, viewsets
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.decorators import detail_route, list_route
-from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.request import clone_request
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken as OriginalObtain
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import Throttled, ValidationError
 
+from .authentication import get_token
+from .bulk import bulk_save_users
+from .caching import cache_user_data, get_cached_user_data
+from .conf import get_setting
+from .export import EXPORT_FORMATS, export_users, parse_since
+from .models import UserKey
+from .pagination import UserCursorPagination
 from .permissions import BaseUserPermission
-from .serializers import UserSerializer, CreateUserSerializer
+from .search import search_users
+from .serializers import UserSerializer, CreateUserSerializer, \
+    ValuesSerializer, get_requested_fields
+from .storage import IMMUTABLE_CACHE_CONTROL
+from .throttling import EMAIL_SENDING_THROTTLES, check_login_failures, \
+    clear_login_failures, get_client_ip, record_login_failure
+from .uploads import HashingMultiPartParser
+
+
+def serve_media(request, path, document_root=None, show_indexes=False):
+    """
+    Serves media files in development, with the cache headers the
+    production web server sends for content-addressed images.
+    """
+    response = serve(request, path, document_root, show_indexes)
+    if path.startswith('images/'):
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
 
 
 class GenericErrorResponse(Response):
@@ -34,22 +66,217 @@ class BaseUserViewSet(viewsets.ModelViewSet):
     Other endpoints:
 
     GET (used to filter)
-    users/upload_image/ (multipart image upload)
+    users/upload_image/ (multipart image upload, sized variants are
+    rendered in the background and listed in image_urls)
+
+    The list is paginated when ?page_size= or ?cursor= is passed.
+    List and detail responses can be trimmed with ?fields=a,b or ?omit=a,b.
+    ?q= searches users, returning a limited number of best matches.
+    ?ids=a,b,c (or POST users/lookup/ {"ids": [...]}) gets many users by id.
+    users/export/ streams all users as NDJSON or CSV (admins only).
+    POST users/bulk/ creates and updates many users at once (admins only).
     """
     serializer_class = UserSerializer
     permission_classes = (BaseUserPermission,)
+    pagination_class = UserCursorPagination
 
     def get_queryset(self):
-        return get_user_model().objects.all()
+        queryset = get_user_model().objects.all()
+        if self.action == 'retrieve':
+            queryset = self.only_requested_fields(queryset)
+        return queryset
+
+    def only_requested_fields(self, queryset):
+        """Only load the columns of the requested fields."""
+        serializer = self.get_serializer()
+        fields = get_requested_fields(self.request, list(serializer.fields))
+        if fields is not None and ValuesSerializer.supports(serializer):
+            queryset = queryset.only(
+                'updated_at', *ValuesSerializer(serializer).columns)
+        return queryset
+
+    def get_variant(self):
+        """
+        Identifies everything other than the user that its representation
+        depends on: the serializer, the query string (e.g. ?fields=), the
+        scheme and host of absolute URLs and the API version.
+        """
+        request = self.request
+        serializer_class = self.get_serializer_class()
+        parts = (serializer_class.__module__, serializer_class.__qualname__,
+                 request.scheme, request.get_host(), request.version,
+                 urlencode(sorted(request.query_params.items())))
+        return hashlib.sha1('\n'.join(
+            str(part) for part in parts).encode()).hexdigest()
+
+    def get_etag(self, pk, updated_at):
+        """The ETag of a user's representation in the accepted format."""
+        parts = (pk, updated_at.isoformat(),
+                 self.request.accepted_renderer.format, self.get_variant())
+        return hashlib.sha1('\n'.join(
+            str(part) for part in parts).encode()).hexdigest()
+
+    def get_not_modified_response(self, pk, updated_at):
+        """
+        Returns a 304 response if the client's copy of the user, named by
+        If-None-Match or If-Modified-Since, is still current.
+        """
+        response = get_conditional_response(
+            self.request, etag=self.get_etag(pk, updated_at),
+            last_modified=int(updated_at.timestamp()))
+        if response is not None:
+            self.set_validators(response, pk, updated_at)
+        return response
+
+    def set_validators(self, response, pk, updated_at):
+        response['ETag'] = quote_etag(self.get_etag(pk, updated_at))
+        response['Last-Modified'] = http_date(updated_at.timestamp())
+        # clients may keep the user, but must check it's current before use
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def is_conditional(self, request):
+        return ('HTTP_IF_NONE_MATCH' in request.META or
+                'HTTP_IF_MODIFIED_SINCE' in request.META)
+
+    def get_user_response(self, pk, get_version, get_user):
+        """
+        Responds with the representation of the user pk, or 304 Not Modified
+        if the client's copy is current.
+
+        Representations are cached, so a hit needs neither a query nor the
+        serializer. On a miss, conditional requests check get_version(), a
+        user with only its pk and updated_at loaded, before get_user()
+        loads the whole user.
+        """
+        key = None
+        if get_setting('USER_DATA_CACHE_TTL'):
+            key, cached = get_cached_user_data(pk, self.get_variant())
+            if cached is not None:
+                updated_at, data = cached
+                # the cached representation stands in for the user
+                self.check_object_permissions(self.request, get_user_model()(
+                    pk=pk, updated_at=updated_at))
+                return (self.get_not_modified_response(pk, updated_at) or
+                        self.set_validators(Response(data), pk, updated_at))
+
+        if self.is_conditional(self.request):
+            version = get_version()
+            response = self.get_not_modified_response(
+                version.pk, version.updated_at)
+            if response is not None:
+                return response
+        user = get_user()
+        data = self.get_serializer(user).data
+        if key is not None:
+            cache_user_data(key, (user.updated_at, dict(data)))
+        return self.set_validators(Response(data), user.pk, user.updated_at)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = {self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        try:
+            pk = get_user_model()._meta.pk.to_python(
+                self.kwargs[lookup_url_kwarg])
+        except DjangoValidationError:
+            raise Http404
+
+        def get_version():
+            version = generics.get_object_or_404(
+                self.filter_queryset(self.get_queryset()).only('updated_at'),
+                **lookup)
+            self.check_object_permissions(request, version)
+            return version
+
+        return self.get_user_response(pk, get_version, self.get_object)
+
+    def get_users_response(self, request, ids):
+        """
+        Responds with a result for each of a list of ids, in order: the
+        status code, the id and either the user's data or the errors. The
+        users are loaded with one query, and checked with the same object
+        permissions as retrieve.
+        """
+        max_ids = get_setting('USER_MULTI_GET_MAX_IDS')
+        if len(ids) > max_ids:
+            return GenericErrorResponse(
+                'At most {} ids can be requested at once'.format(max_ids))
+        model = get_user_model()
+        results = [None] * len(ids)
+        pks = {}
+        for index, value in enumerate(ids):
+            try:
+                if not isinstance(value, str):
+                    raise DjangoValidationError('Expected a string.')
+                pks[index] = model._meta.pk.to_python(value)
+            except DjangoValidationError as e:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST,
+                                  'id': value, 'errors': {'id': e.messages}}
+        users = self.filter_queryset(self.only_requested_fields(
+            self.get_queryset())).in_bulk(set(pks.values()))
+
+        for index, pk in pks.items():
+            user = users.get(pk)
+            try:
+                if user is None:
+                    raise exceptions.NotFound
+                self.check_object_permissions(request, user)
+            except exceptions.APIException as exc:
+                results[index] = {'status': exc.status_code, 'id': ids[index],
+                                  'errors': {'detail': exc.detail}}
+            else:
+                results[index] = {'status': status.HTTP_200_OK,
+                                  'id': ids[index],
+                                  'data': self.get_serializer(user).data}
+        return Response(results)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Serializes .values() rows instead of model instances, which is much
+        cheaper for large lists.
+        """
+        ids = request.query_params.get('ids')
+        if ids is not None:
+            return self.get_users_response(
+                request, [pk for pk in ids.split(',') if pk])
+
+        serializer = self.get_serializer(many=True).child
+        if not ValuesSerializer.supports(serializer):
+            return super().list(request, *args, **kwargs)
+        values_serializer = ValuesSerializer(serializer)
+        # pagination needs the (date_joined, id) position of every row
+        columns = set(values_serializer.columns) | {'date_joined', 'id'}
+        queryset = self.filter_queryset(self.get_queryset())
+
+        query = request.query_params.get('q')
+        if query:
+            queryset = search_users(queryset, query).values(*columns)
+            return Response(values_serializer.to_representation(
+                queryset[:get_setting('USER_SEARCH_LIMIT')]))
+
+        queryset = queryset.values(*columns)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(
+                values_serializer.to_representation(page))
+        return Response(values_serializer.to_representation(queryset))
 
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateUserSerializer
         return UserSerializer
 
+    def get_throttles(self):
+        # anyone can sign up, which emails the address they give
+        if self.action == 'create' and \
+                not self.request.user.is_authenticated():
+            self.throttle_scope = 'create_user'
+            return [throttle() for throttle in EMAIL_SENDING_THROTTLES]
+        return super().get_throttles()
+
     # TODO: Remove this detail_route and list_route in favor of
     # default crud operations
-    @detail_route(methods=['POST'], parser_classes=[MultiPartParser])
+    @detail_route(methods=['POST'], parser_classes=[HashingMultiPartParser])
     def upload_image(self, request, pk=None):
         user = self.get_object()
         user.image = request.FILES.get('file')
@@ -66,10 +293,84 @@ class BaseUserViewSet(viewsets.ModelViewSet):
         token_string = request.query_params.get('token')
         if not token_string:
             return GenericErrorResponse('Token query parameter is required')
-        token = get_object_or_404(Token, key=token_string)
-        self.kwargs['pk'] = token.user_id
-        user = self.get_object()
-        return Response(self.get_serializer(user).data)
+        token = get_token(token_string)
+        if token is None:
+            raise Http404
+        # the cached token comes with its user
+        user = token.user
+        self.check_object_permissions(request, user)
+
+        def get_version():
+            updated_at = get_user_model().objects.filter(
+                pk=user.pk).values_list('updated_at', flat=True).first()
+            if updated_at is None:
+                raise Http404
+            return get_user_model()(pk=user.pk, updated_at=updated_at)
+
+        def get_user():
+            # the cached token's user can be older than the stored one, which
+            # mustn't be cached as the current representation
+            return self.get_queryset().get(pk=user.pk)
+
+        return self.get_user_response(user.pk, get_version, get_user)
+
+    @list_route(methods=['POST'])
+    def lookup(self, request):
+        """
+        Takes {"ids": [...]} and responds like ?ids=, for lists of ids too
+        long for a URL.
+        """
+        # this only reads users, so check the permissions of a GET
+        read_request = clone_request(request, 'GET')
+        self.check_permissions(read_request)
+        ids = request.data.get('ids') if isinstance(request.data, dict) \
+            else None
+        if not isinstance(ids, list):
+            return GenericErrorResponse('Expected a list of ids')
+        return self.get_users_response(read_request, ids)
+
+    @list_route(methods=['POST'], permission_classes=[IsAdminUser])
+    def bulk(self, request):
+        """
+        Creates and partially updates users from a JSON list: items with an
+        id update that user, the rest are created. Valid items are written
+        together even if others fail; the response holds a
+        {"status", "data" or "errors"} result for each item, in order.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return GenericErrorResponse('Expected a list of users')
+        max_users = get_setting('BULK_MAX_USERS')
+        if len(items) > max_users:
+            return GenericErrorResponse(
+                'At most {} users can be sent at once'.format(max_users))
+        return Response(bulk_save_users(
+            get_user_model(), items, self.get_serializer_context()))
+
+    @list_route(permission_classes=[IsAdminUser])
+    def export(self, request):
+        """
+        Streams every user as NDJSON (default) or CSV, picked with
+        ?file_format=ndjson|csv. ?since= (a date or datetime) only exports
+        users who joined since then, and ?fields= or ?omit= pick the fields.
+        """
+        export_format = request.query_params.get('file_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return GenericErrorResponse('file_format must be one of: {}'.format(
+                ', '.join(sorted(EXPORT_FORMATS))))
+        queryset = self.filter_queryset(self.get_queryset())
+        since = request.query_params.get('since')
+        if since:
+            since = parse_since(since)
+            if since is None:
+                return GenericErrorResponse('since must be a date or datetime')
+            queryset = queryset.filter(date_joined__gte=since)
+        response = StreamingHttpResponse(
+            export_users(queryset, self.get_serializer(), export_format),
+            content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = (
+            'attachment; filename="users.{}"'.format(export_format))
+        return response
 
     @list_route(methods=['POST'], permission_classes=[IsAdminUser])
     def impersonate(self, request):
@@ -96,9 +397,15 @@ class ResetPassword(views.APIView):
     #     return render(self.request, 'password/reset_password.html',
     #                   {'form': form, 'success': success, 'note': note})
 
+    def get_user(self):
+        user = UserKey.get_user(
+            self.kwargs.get('validation_key'), UserKey.RESET_PASSWORD)
+        if user is None:
+            raise Http404
+        return user
+
     def get(self, *args, **kwargs):
-        key = kwargs.get('validation_key')
-        user = get_object_or_404(get_user_model(), validation_key=key)
+        user = self.get_user()
         return Response(user.email)
 
     def post(self, request, *args, **kwargs):
@@ -109,8 +416,7 @@ class ResetPassword(views.APIView):
             return HttpResponseBadRequest('Must have a password')
         if password != re_entered:
             return HttpResponseBadRequest('Passwords must match')
-        validation_key = kwargs.get('validation_key')
-        user = get_user_model().objects.get(validation_key=validation_key)
+        user = self.get_user()
         user.set_password(password)
         user.save()
         user.send_reset_password_success_email()
@@ -122,6 +428,8 @@ class RequestPasswordChange(views.APIView):
     """
     permission_classes = [AllowAny]
     authentication_classes = []
+    throttle_classes = EMAIL_SENDING_THROTTLES
+    throttle_scope = 'reset_password'
 
     def post(self, request, *args, **kwargs):
         email = kwargs.get('email')
@@ -139,24 +447,36 @@ class ValidateUserView(TemplateView):
     template_name = 'validation/validate.html'
 
     def get_context_data(self, **kwargs):
-        validation_key = kwargs.get('validation_key')
-        user = get_object_or_404(
-            get_user_model(), validation_key=validation_key)
+        user = UserKey.get_user(
+            kwargs.get('validation_key'), UserKey.VALIDATION)
+        if user is None:
+            raise Http404
         user.validate()
 
 
 class ObtainAuthToken(OriginalObtain):
     def post(self, request, require_validated=True):
+        # turn away clients with too many recent failures before hashing
+        # their password, so guessing can't tie up every worker's CPU
+        ip = get_client_ip(request)
+        email = request.data.get('username') \
+            if isinstance(request.data, dict) else None
+        wait = check_login_failures(ip, email)
+        if wait is not None:
+            raise Throttled(wait)
+
         serializer = self.serializer_class(data=request.data)
 
         try:
             serializer.is_valid(raise_exception=True)
         except ValidationError as err:
             if 'non_field_errors' in err.detail:
+                record_login_failure(ip, email)
                 return Response(status=401)
             raise err
 
         user = serializer.validated_data['user']
+        clear_login_failures(email)
         if require_validated and not user.validated_at:
             response = GenericErrorResponse('User not validated')
             response.status_code = 401
@@ -0,0 +1,265 @@
+"""
+A Django cache backend shared by every process on a host.
+
+Entries live in a memory-mapped file (put it on a tmpfs such as /dev/shm), so
+all uWSGI workers share one warm cache and see each other's invalidations.
+
+The file is a fixed-size table of MAX_ENTRIES slots, each holding one entry of
+up to MAX_VALUE_SIZE pickled bytes; larger values are not cached. A key may
+live in any of the ASSOCIATIVITY slots following its hash, and when they are
+all in use the least recently used one is evicted. Processes coordinate with
+flock(), and threads within a process with a lock.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'radius.cache.SharedMemoryCache',
+            'LOCATION': '/dev/shm/radius-cache',
+            'OPTIONS': {'MAX_ENTRIES': 16384, 'MAX_VALUE_SIZE': 4096},
+        }
+    }
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+MAGIC = b'RADC'
+VERSION = 1
+# magic, version, number of slots, value size
+HEADER = struct.Struct('<4sIII')
+HEADER_SIZE = 64
+# key hash, expiry time (0 = never), last used time, value length
+SLOT = struct.Struct('<16sddI')
+EMPTY = bytes(16)
+ASSOCIATIVITY = 8
+
+
+class SharedMemoryCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._path = location
+        self._slots = int(options.get('MAX_ENTRIES', 16384))
+        self._value_size = int(options.get('MAX_VALUE_SIZE', 4096))
+        self._slot_size = SLOT.size + self._value_size
+        self._size = HEADER_SIZE + self._slots * self._slot_size
+        self._thread_lock = threading.RLock()
+        self._pid = None
+        self._file = self._map = None
+
+    # File handling
+
+    def _open(self):
+        """
+        Map the cache file, creating or replacing it if its layout doesn't
+        match our options. Each process opens its own file description, so
+        flock() works between processes that were forked after mapping.
+        """
+        if self._map is not None:
+            self._map.close()
+            os.close(self._file)
+        header = HEADER.pack(MAGIC, VERSION, self._slots, self._value_size)
+        while True:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if self._is_current(fd, header):
+                    break
+                if os.fstat(fd).st_ino == self._path_inode():
+                    self._replace(header)
+                # else another process replaced the file while we waited
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._file = fd
+        self._map = mmap.mmap(fd, self._size)
+        self._pid = os.getpid()
+
+    def _path_inode(self):
+        try:
+            return os.stat(self._path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _is_current(self, fd, header):
+        """Whether fd is the file at our path, laid out for our options."""
+        stat = os.fstat(fd)
+        return (stat.st_ino == self._path_inode() and
+                stat.st_size == self._size and
+                os.pread(fd, HEADER.size, 0) == header)
+
+    def _replace(self, header):
+        """
+        Put an empty file with our layout at our path. Other processes may
+        still have the old file mapped, e.g. during a rolling restart that
+        changes MAX_ENTRIES; truncating it under them would kill them with
+        SIGBUS, so they keep it until they restart.
+        """
+        directory, name = os.path.split(self._path)
+        fd, path = tempfile.mkstemp(prefix=name + '.', dir=directory or '.')
+        try:
+            os.ftruncate(fd, self._size)
+            os.pwrite(fd, header, 0)
+            os.rename(path, self._path)
+        except BaseException:
+            os.remove(path)
+            raise
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._file,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    # Slot handling; callers must hold the lock
+
+    def _key_hash(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * self._slot_size
+
+    def _candidates(self, key_hash):
+        start = int.from_bytes(key_hash[:8], 'little') % self._slots
+        return [(start + i) % self._slots for i in range(ASSOCIATIVITY)]
+
+    def _read_slot(self, index):
+        return SLOT.unpack_from(self._map, self._offset(index))
+
+    def _find(self, key_hash, now):
+        """Return the slot index of a live entry, or None."""
+        for index in self._candidates(key_hash):
+            slot_hash, expires, last_used, length = self._read_slot(index)
+            if slot_hash == key_hash:
+                if expires and expires <= now:
+                    return None
+                return index
+        return None
+
+    def _get(self, key_hash, now):
+        index = self._find(key_hash, now)
+        if index is None:
+            return None, False
+        offset = self._offset(index)
+        slot_hash, expires, last_used, length = self._read_slot(index)
+        data = self._map[offset + SLOT.size:offset + SLOT.size + length]
+        try:
+            value = pickle.loads(data)
+        except Exception:
+            # a torn or unreadable entry; drop it, so this is a miss once.
+            # Any other reader would write the same bytes, so this is safe
+            # under a shared lock too.
+            self._map[offset:offset + 16] = EMPTY
+            return None, False
+        # touch the entry for LRU; an 8-byte store, safe under a shared lock
+        struct.pack_into('<d', self._map, offset + 24, now)
+        return value, True
+
+    def _set(self, key_hash, value, timeout, now):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self._value_size:
+            return False
+        victim = victim_used = None
+        for index in self._candidates(key_hash):
+            slot_hash, expires, last_used, length = self._read_slot(index)
+            if slot_hash == key_hash:
+                victim = index
+                break
+            if slot_hash == EMPTY or (expires and expires <= now):
+                last_used = -1
+            if victim is None or last_used < victim_used:
+                victim, victim_used = index, last_used
+        offset = self._offset(victim)
+        expires = self.get_backend_timeout(timeout) or 0
+        # empty the slot, write the value, then the header: a process
+        # killed in between leaves an empty slot rather than a header
+        # describing bytes that were never written
+        self._map[offset:offset + 16] = EMPTY
+        self._map[offset + SLOT.size:offset + SLOT.size + len(data)] = data
+        SLOT.pack_into(self._map, offset, key_hash, expires, now, len(data))
+        return True
+
+    def _delete(self, key_hash):
+        for index in self._candidates(key_hash):
+            offset = self._offset(index)
+            if self._map[offset:offset + 16] == key_hash:
+                self._map[offset:offset + 16] = EMPTY
+                return True
+        return False
+
+    # Cache API
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked():
+            now = time.time()
+            if self._find(key_hash, now) is not None:
+                return False
+            return self._set(key_hash, value, timeout, now)
+
+    def get(self, key, default=None, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked(exclusive=False):
+            value, found = self._get(key_hash, time.time())
+        return value if found else default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked():
+            if not self._set(key_hash, value, timeout, time.time()):
+                # too big to cache; don't leave a stale value behind
+                self._delete(key_hash)
+
+    def delete(self, key, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked():
+            self._delete(key_hash)
+
+    def has_key(self, key, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked(exclusive=False):
+            return self._find(key_hash, time.time()) is not None
+
+    def incr(self, key, delta=1, version=None):
+        key_hash = self._key_hash(key, version)
+        with self._locked():
+            now = time.time()
+            index = self._find(key_hash, now)
+            if index is not None:
+                expires = self._read_slot(index)[1]
+                value, found = self._get(key_hash, now)
+            if index is None or not found:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = value + delta
+            timeout = max(expires - now, 0.001) if expires else None
+            self._set(key_hash, new_value, timeout, now)
+        return new_value
+
+    def clear(self):
+        with self._locked():
+            empty = bytes(self._slot_size)
+            for index in range(self._slots):
+                offset = self._offset(index)
+                self._map[offset:offset + self._slot_size] = empty
+
+    def close(self, **kwargs):
+        # the mapping is reused across requests
+        pass
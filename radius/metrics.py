@@ -0,0 +1,369 @@
+"""
+Per-endpoint request metrics, aggregated across uWSGI workers and served in
+the Prometheus text format.
+
+MetricsMiddleware times every request and counts its SQL queries, keyed by
+the resolved URL name (e.g. users-list). Each worker keeps its numbers in
+memory and every METRICS_FLUSH_INTERVAL seconds writes them to its own file
+in METRICS_DIR (put it on a tmpfs such as /dev/shm); the admin-only
+/metrics view adds up the files of all workers. The files of workers that
+have exited are folded into one, so the totals never go backwards.
+
+    MIDDLEWARE_CLASSES = ('radius.metrics.MetricsMiddleware', ...)
+    METRICS_DIR = '/dev/shm/radius-metrics'
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework import views
+from rest_framework.permissions import IsAdminUser
+
+# upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# the totals of workers that have exited
+RETIRED_FILE = 'retired.json'
+
+
+def get_metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(
+        tempfile.gettempdir(), 'radius-metrics')
+
+
+def _observe(buckets, counts, value):
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            counts[index] += 1
+            return
+    counts[-1] += 1
+
+
+def _write_json(path, data):
+    # replace the file in one step, so readers never see half of it
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+class Metrics:
+    """
+    The metrics of one process, by (URL name, method).
+
+    A worker's file is named after its pid and start time, so a new worker
+    that gets a dead one's pid doesn't overwrite its numbers. The worker
+    holds a lock on a matching .lock file while it lives, which tells
+    collect() which files belong to workers that have exited.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def _start(self):
+        """
+        Start afresh in a new process; uWSGI forks workers after importing
+        the app. Callers must hold self.lock.
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.series = {}
+        self.last_flush = time.monotonic()
+        self.name = '{}-{}'.format(self.pid, int(time.time() * 1e6))
+        self.lock_file = self.lock_path = None
+
+    def observe(self, view, method, status, duration, queries, sql_time):
+        with self.lock:
+            self._start()
+            series = self.series.get((view, method))
+            if series is None:
+                series = self.series[view, method] = {
+                    'view': view, 'method': method, 'statuses': {},
+                    # one count per bucket, then one past the last bound
+                    'duration': [0] * (len(DURATION_BUCKETS) + 1),
+                    'duration_sum': 0.0,
+                    'queries': [0] * (len(QUERY_BUCKETS) + 1),
+                    'queries_sum': 0,
+                    'sql_seconds_sum': 0.0,
+                }
+            status = str(status)
+            series['statuses'][status] = series['statuses'].get(status, 0) + 1
+            _observe(DURATION_BUCKETS, series['duration'], duration)
+            series['duration_sum'] += duration
+            _observe(QUERY_BUCKETS, series['queries'], queries)
+            series['queries_sum'] += queries
+            series['sql_seconds_sum'] += sql_time
+
+    def flush(self, force=False):
+        """
+        Write this process's metrics to its file, at most every
+        METRICS_FLUSH_INTERVAL seconds unless forced.
+        """
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+        with self.lock:
+            self._start()
+            now = time.monotonic()
+            if not force and now - self.last_flush < interval:
+                return
+            self.last_flush = now
+            directory = get_metrics_dir()
+            path = os.path.join(directory, self.name)
+            if self.lock_path != path + '.lock':
+                os.makedirs(directory, exist_ok=True)
+                if self.lock_file is not None:
+                    os.close(self.lock_file)
+                # held until the process exits
+                self.lock_path = path + '.lock'
+                self.lock_file = os.open(
+                    self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            _write_json(path + '.json', list(self.series.values()))
+
+
+metrics = Metrics()
+
+
+def _add(totals, worker_series):
+    """Add the series of a worker to totals, by (URL name, method)."""
+    for series in worker_series:
+        total = totals.setdefault((series['view'], series['method']), {
+            'view': series['view'], 'method': series['method'],
+            'statuses': {},
+            'duration': [0] * len(series['duration']),
+            'duration_sum': 0.0,
+            'queries': [0] * len(series['queries']), 'queries_sum': 0,
+            'sql_seconds_sum': 0.0,
+        })
+        for status, count in series['statuses'].items():
+            total['statuses'][status] = \
+                total['statuses'].get(status, 0) + count
+        for key in ('duration', 'queries'):
+            total[key] = [a + b for a, b in zip(total[key], series[key])]
+        for key in ('duration_sum', 'queries_sum', 'sql_seconds_sum'):
+            total[key] += series[key]
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _has_exited(directory, name):
+    """Whether the worker that wrote a file no longer holds its lock."""
+    try:
+        fd = os.open(os.path.join(directory, name[:-len('.json')] + '.lock'),
+                     os.O_RDWR)
+    except FileNotFoundError:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def collect():
+    """
+    Adds up the metrics files of every worker, first folding the files of
+    workers that have exited into the retired file.
+    """
+    metrics.flush(force=True)
+    directory = get_metrics_dir()
+    fd = os.open(os.path.join(directory, 'collect.lock'),
+                 os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        # one scrape at a time, so a file isn't retired twice
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        names = [name for name in sorted(os.listdir(directory))
+                 if name.endswith('.json') and name != RETIRED_FILE]
+        exited = [name for name in names if _has_exited(directory, name)]
+        retired = {}
+        _add(retired, _read(os.path.join(directory, RETIRED_FILE)))
+        if exited:
+            for name in exited:
+                _add(retired, _read(os.path.join(directory, name)))
+            _write_json(os.path.join(directory, RETIRED_FILE),
+                        list(retired.values()))
+            for name in exited:
+                for path in (name, name[:-len('.json')] + '.lock'):
+                    try:
+                        os.remove(os.path.join(directory, path))
+                    except FileNotFoundError:
+                        pass
+    finally:
+        os.close(fd)
+
+    totals = retired
+    for name in names:
+        if name not in exited:
+            _add(totals, _read(os.path.join(directory, name)))
+    return [totals[key] for key in sorted(totals)]
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for name, value in labels.items()) + '}'
+
+
+def _histogram(lines, name, buckets, counts, total, labels):
+    cumulative = 0
+    for bound, count in zip(buckets + ('+Inf',), counts):
+        cumulative += count
+        lines.append('{}_bucket{} {}'.format(
+            name, _labels(**dict(labels, le=bound)), cumulative))
+    lines.append('{}_sum{} {}'.format(name, _labels(**labels), total))
+    lines.append('{}_count{} {}'.format(name, _labels(**labels), cumulative))
+
+
+def render(all_series):
+    """Render the metrics in the Prometheus text exposition format."""
+    lines = [
+        '# HELP radius_http_requests_total Requests handled, by URL name.',
+        '# TYPE radius_http_requests_total counter',
+    ]
+    for series in all_series:
+        for status, count in sorted(series['statuses'].items()):
+            lines.append('radius_http_requests_total{} {}'.format(_labels(
+                view=series['view'], method=series['method'],
+                status=status), count))
+
+    lines += [
+        '# HELP radius_http_request_duration_seconds Time to respond, '
+        'by URL name.',
+        '# TYPE radius_http_request_duration_seconds histogram',
+    ]
+    for series in all_series:
+        _histogram(lines, 'radius_http_request_duration_seconds',
+                   DURATION_BUCKETS, series['duration'],
+                   series['duration_sum'],
+                   dict(view=series['view'], method=series['method']))
+
+    lines += [
+        '# HELP radius_http_request_queries SQL queries per request, '
+        'by URL name.',
+        '# TYPE radius_http_request_queries histogram',
+    ]
+    for series in all_series:
+        _histogram(lines, 'radius_http_request_queries', QUERY_BUCKETS,
+                   series['queries'], series['queries_sum'],
+                   dict(view=series['view'], method=series['method']))
+
+    lines += [
+        '# HELP radius_http_request_sql_seconds_total Time spent in SQL '
+        'queries, by URL name.',
+        '# TYPE radius_http_request_sql_seconds_total counter',
+    ]
+    for series in all_series:
+        lines.append('radius_http_request_sql_seconds_total{} {}'.format(
+            _labels(view=series['view'], method=series['method']),
+            series['sql_seconds_sum']))
+    return '\n'.join(lines) + '\n'
+
+
+class QueryCounterMixin:
+    """
+    Counts the queries run through a cursor, and the time they take, in its
+    connection's metrics_counts: a [queries, seconds] list.
+    """
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.count(start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            self.count(start)
+
+    def count(self, start):
+        counts = self.db.metrics_counts
+        counts[0] += 1
+        counts[1] += time.perf_counter() - start
+
+
+class CountingCursorWrapper(QueryCounterMixin, CursorWrapper):
+    pass
+
+
+class CountingCursorDebugWrapper(QueryCounterMixin, CursorDebugWrapper):
+    pass
+
+
+def count_queries(connection):
+    """
+    Makes a connection count its queries in connection.metrics_counts. This
+    is the cursor wrapper Django would use anyway plus a counter, so unlike
+    the debug cursor no SQL is formatted, logged or kept.
+    """
+    if hasattr(connection, 'metrics_counts'):
+        return
+    connection.metrics_counts = [0, 0.0]
+    connection.make_cursor = \
+        lambda cursor: CountingCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = \
+        lambda cursor: CountingCursorDebugWrapper(cursor, connection)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Records the latency, SQL query count and SQL time of each request under
+    its URL name. Put it first, so the time of the other middleware counts.
+    """
+    def process_request(self, request):
+        # the counts of each connection when the request started, by alias;
+        # connections belong to a thread, as requests do
+        request._metrics_counts = {}
+        for connection in connections.all():
+            count_queries(connection)
+            request._metrics_counts[connection.alias] = \
+                connection.metrics_counts[:]
+        request._metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        queries, sql_time = 0, 0.0
+        for connection in connections.all():
+            count_queries(connection)
+            start_queries, start_time = request._metrics_counts.get(
+                connection.alias, (0, 0.0))
+            queries += connection.metrics_counts[0] - start_queries
+            sql_time += connection.metrics_counts[1] - start_time
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.view_name if resolver_match else 'unresolved'
+        metrics.observe(view, request.method, response.status_code,
+                        duration, queries, sql_time)
+        metrics.flush()
+        return response
+
+
+class MetricsView(views.APIView):
+    """The metrics of all workers, in the Prometheus text format."""
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
@@ -10,6 +10,10 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'server', 'dev', 'media')
 STATIC_ROOT = os.path.join(BASE_DIR, 'server', 'dev', 'static') # The absolute path to the directory where collectstatic will collect static files for deployment.
 AUTH_PASSWORD_VALIDATORS = []  # disable password policies
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+}
+METRICS_DIR = None  # a directory in the system's temporary directory
 # TODO: Remove Pagination for now
 # REST_FRAMEWORK['PAGE_SIZE'] = 1
 
@@ -13,6 +13,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
 
 
 MIDDLEWARE_CLASSES = (
+    'radius.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -59,14 +60,18 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.BrowsableAPIRenderer'
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'apps.base_accounts.authentication.CachedTokenAuthentication',
         'apps.accounts.authentication.NoCSRFSessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAdminUser',
     ),
     'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.AcceptHeaderVersioning',
+    'DEFAULT_PAGINATION_CLASS':
+        'apps.base_accounts.pagination.EstimatedCountPageNumberPagination',
     # 'PAGE_SIZE': 100,
+    # Caddy passes the client address in X-Forwarded-For
+    'NUM_PROXIES': 1,
 }
 
 CORS_ORIGIN_WHITELIST = [
@@ -204,8 +209,19 @@ LOGGING = {
 
 
 # Caching
+# Where each uWSGI worker writes its request metrics, see radius/metrics.py
+METRICS_DIR = '/dev/shm/radius-metrics'
+
+# One cache shared by every uWSGI worker on the host, see radius/cache.py
 CACHES = {
-    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    'default': {
+        'BACKEND': 'radius.cache.SharedMemoryCache',
+        'LOCATION': '/dev/shm/radius-cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 16384,
+            'MAX_VALUE_SIZE': 4096,
+        },
+    }
 }
 
 
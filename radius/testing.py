@@ -0,0 +1,58 @@
+"""
+Test helpers for keeping an eye on what API calls cost.
+
+    class UsersTestCase(BudgetMixin, TestCase):
+        def test_detail(self):
+            with self.assertBudget(queries=2, size=1000):
+                response = self.client.get(url)
+
+A budget caps the SQL queries run inside the block and the size of each
+response body the test client gets there. Pick budgets that don't depend on
+how many rows the tables hold, so an N+1 query or an unpaginated list fails
+the test instead of slowing down production.
+"""
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class BudgetMixin:
+    """Adds assertBudget() to a test case that has a test client."""
+
+    @contextmanager
+    def assertBudget(self, queries=None, size=None, using=DEFAULT_DB_ALIAS):
+        """
+        Fails if the block runs more than `queries` SQL queries, or if a
+        response to the test client in it has a body of more than `size`
+        bytes. The failure lists the queries, or names the response.
+        """
+        responses = []
+        request = self.client.request
+
+        def record(**kwargs):
+            response = request(**kwargs)
+            responses.append(response)
+            return response
+
+        self.client.request = record
+        try:
+            with CaptureQueriesContext(connections[using]) as captured:
+                yield responses
+        finally:
+            del self.client.request
+
+        if queries is not None and len(captured) > queries:
+            self.fail('{} queries run, over the budget of {}:\n{}'.format(
+                len(captured), queries, '\n'.join(
+                    '{}. {}'.format(i, query['sql'])
+                    for i, query in enumerate(captured, start=1))))
+        if size is not None:
+            for response in responses:
+                if response.streaming:
+                    continue
+                if len(response.content) > size:
+                    self.fail('{} {} returned {} bytes, over the budget of '
+                              '{}'.format(response.request['REQUEST_METHOD'],
+                                          response.request['PATH_INFO'],
+                                          len(response.content), size))
@@ -1,15 +1,45 @@
+import datetime
+import fcntl
+import hashlib
+import io
 import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from unittest import mock
 
 from apps.base_accounts.tests import AccountsTestCase
+from django.contrib import admin
 from django.contrib.auth import get_user_model
-from django.test import Client
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, \
+    override_settings
+from django.utils import timezone
 from django.contrib.staticfiles.testing import LiveServerTestCase
+from PIL import Image
+from rest_framework.authtoken.models import Token
 from rest_framework.reverse import reverse
+from apps.accounts.management.commands.load_data import iter_json_objects
 from apps.accounts.models import EmailUser
+from apps.base_accounts import bulk
+from apps.base_accounts.caching import invalidate_user_data, \
+    user_data_stats
+from apps.base_accounts.models import QueuedEmail, UserKey
+from apps.base_accounts.serializers import UserSerializer
+from apps.base_accounts.views import serve_media
+from radius.cache import SLOT, SharedMemoryCache
+from radius.testing import BudgetMixin
 
 
-class AccountsTestCase(LiveServerTestCase):
+class AccountsTestCase(BudgetMixin, LiveServerTestCase):
     def setUp(self):
+        # throttles keep their buckets in the cache
+        cache.clear()
         self.userOne = {
             'email': 'one@example.com',
             'password': 'p',
@@ -58,7 +88,8 @@ class AccountsTestCase(LiveServerTestCase):
         """
         Declines unauthorized users from getting all users
         """
-        response = self.client.get(reverse('users-list'))
+        with self.assertBudget(queries=0, size=200):
+            response = self.client.get(reverse('users-list'))
         self.assertEqual(response.status_code, 401)
 
     def test_get_detail_without_auth(self):
@@ -74,8 +105,9 @@ class AccountsTestCase(LiveServerTestCase):
         Allows getting other users
         """
         self.get_login(self.userTwo['email'], self.userTwo['password'])
-        response = self.client.get(reverse('users-detail',
-                                           args=[self.user_one.id]))
+        with self.assertBudget(queries=3, size=1000):
+            response = self.client.get(reverse('users-detail',
+                                               args=[self.user_one.id]))
         self.assertEqual(response.data['first_name'], 'FirstNameOne')
 
     def test_get_users(self):
@@ -83,8 +115,14 @@ class AccountsTestCase(LiveServerTestCase):
         Allows getting user lists
         """
         self.get_login(self.userTwo['email'], self.userTwo['password'])
-        response = self.client.get(reverse('users-list'))
+        # the whole list grows with the users, its query count doesn't
+        with self.assertBudget(queries=3):
+            response = self.client.get(reverse('users-list'))
         self.assertEqual(response.status_code, 200)
+        with self.assertBudget(queries=3, size=2000):
+            response = self.client.get(reverse('users-list'),
+                                       {'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_edit_other_user(self):
         """
@@ -101,7 +139,9 @@ class AccountsTestCase(LiveServerTestCase):
         Allows superusers to edit other users
         """
         self.get_login('a@a.com', 'p')
-        response = self.patch_detail(self.user_two.id, {"first_name": "Bill"})
+        with self.assertBudget(queries=5, size=1000):
+            response = self.patch_detail(self.user_two.id,
+                                         {"first_name": "Bill"})
         self.assertEqual(response.data["first_name"], "Bill")
 
     def test_edit_self(self):
@@ -109,7 +149,9 @@ class AccountsTestCase(LiveServerTestCase):
         Allows user to edit themselves
         """
         self.get_login(self.userThree['email'], self.userThree['password'])
-        response = self.patch_detail(self.user_three.id, {"first_name": "Bill"})
+        with self.assertBudget(queries=5, size=1000):
+            response = self.patch_detail(self.user_three.id,
+                                         {"first_name": "Bill"})
         self.assertEqual(response.data["first_name"], "Bill")
 
     def test_edit_status(self):
@@ -130,7 +172,8 @@ class AccountsTestCase(LiveServerTestCase):
         Allows deleting yourself
         """
         self.get_login(self.userThree['email'], self.userThree['password'])
-        response = self.delete_detail(self.user_three.id)
+        with self.assertBudget(queries=10, size=0):
+            response = self.delete_detail(self.user_three.id)
         self.assertEqual(response.status_code, 204)
 
     def test_delete_other(self):
@@ -148,7 +191,8 @@ class AccountsTestCase(LiveServerTestCase):
         Allows superusers to delete other users
         """
         self.get_login('a@a.com', 'p')
-        response = self.delete_detail(self.user_two.id)
+        with self.assertBudget(queries=10, size=0):
+            response = self.delete_detail(self.user_two.id)
         self.assertEqual(response.status_code, 204)
 
     def test_create_user(self):
@@ -159,7 +203,8 @@ class AccountsTestCase(LiveServerTestCase):
                           'password': 'password',
                           'first_name': 'FirstName',
                           'last_name': 'LastName', }
-        response = self.client.post(reverse('users-list'), self.userEight)
+        with self.assertBudget(queries=10, size=1000):
+            response = self.client.post(reverse('users-list'), self.userEight)
         self.assertEqual(response.status_code, 201)
 
     def test_create_superuser(self):
@@ -177,4 +222,813 @@ class AccountsTestCase(LiveServerTestCase):
         response = self.patch_detail(self.user_two.id, {'first_name': 'John'})
         self.assertEqual(
             response.data,
-            {'detail': 'You do not have permission to perform this action.'})
\ No newline at end of file
+            {'detail': 'You do not have permission to perform this action.'})
+
+    def test_budgets_hold_with_many_users(self):
+        """
+        Keeps list, detail, edit, delete and create calls within the same
+        budgets with a thousand users as with a handful
+        """
+        model = get_user_model()
+        model.objects.bulk_create(
+            model(email='user{}@example.com'.format(i),
+                  first_name='First{}'.format(i), last_name='Last{}'.format(i))
+            for i in range(1000 - model.objects.count()))
+        self.test_get_list_without_auth()
+        self.test_get_users()
+        self.test_get_other_user()
+        self.test_super_edit_other_user()
+        self.test_edit_self()
+        self.client.logout()
+        self.test_create_user()
+        self.test_super_delete_other()
+        self.test_delete_self()
+
+    def test_get_users_paginated(self):
+        """
+        Pages through the user list with cursors when a page size is given
+        """
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        response = self.client.get(reverse('users-list'), {'page_size': 3})
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIsNone(response.data['previous'])
+        first_page = [user['id'] for user in response.data['results']]
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+        self.assertNotIn(response.data['results'][0]['id'], first_page)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(
+            [user['id'] for user in response.data['results']], first_page)
+
+    def test_get_users_paginated_same_date_joined(self):
+        """
+        Pages through users who signed up at the same time in id order
+        """
+        EmailUser.objects.update(date_joined=timezone.now())
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        ids = []
+        response = self.client.get(reverse('users-list'), {'page_size': 1})
+        while True:
+            ids.extend(user['id'] for user in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, sorted(
+            str(pk) for pk in EmailUser.objects.values_list('pk', flat=True)))
+
+    def test_get_users_invalid_cursor(self):
+        """
+        Rejects cursors that weren't issued by the API
+        """
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        response = self.client.get(reverse('users-list'), {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_users_sparse_fields(self):
+        """
+        Returns only the requested fields
+        """
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        response = self.client.get(reverse('users-list'),
+                                   {'fields': 'id,email'})
+        self.assertEqual(set(response.data[0]), {'id', 'email'})
+        response = self.client.get(reverse('users-detail',
+                                           args=[self.user_one.id]),
+                                   {'omit': 'image,phone'})
+        self.assertNotIn('image', response.data)
+        self.assertNotIn('phone', response.data)
+        self.assertEqual(response.data['first_name'], 'FirstNameOne')
+
+    def test_list_matches_detail(self):
+        """
+        List rows are serialized the same way as detail responses
+        """
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        EmailUser.objects.filter(pk=self.user_one.pk).update(
+            image='users/one/profile.png', birthdate='1990-01-02')
+        detail = self.client.get(reverse('users-detail',
+                                         args=[self.user_one.id]))
+        response = self.client.get(reverse('users-list'))
+        row = next(user for user in response.data
+                   if user['id'] == str(self.user_one.id))
+        self.assertEqual(row, detail.data)
+
+    def test_token_auth_is_cached(self):
+        """
+        Authenticates repeat token requests without querying for the token
+        """
+        token = Token.objects.create(user=self.user_one)
+        url = reverse('users-detail', args=[self.user_two.id])
+        auth = 'Token {}'.format(token.key)
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 200)
+        # only the user is queried, when their data isn't cached either
+        with self.assertNumQueries(1), mock.patch.dict(
+                'apps.base_accounts.conf.DEFAULTS', {'USER_DATA_CACHE_TTL': 0}):
+            response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 200)
+
+        token.delete()
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_cache_sees_user_changes(self):
+        """
+        Saving a user drops their cached token
+        """
+        token = Token.objects.create(user=self.user_one)
+        url = reverse('users-from-token')
+        auth = 'Token {}'.format(token.key)
+        self.client.get(url, {'token': token.key}, HTTP_AUTHORIZATION=auth)
+        self.user_one.first_name = 'Changed'
+        self.user_one.save()
+        response = self.client.get(url, {'token': token.key},
+                                   HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.data['first_name'], 'Changed')
+
+    def test_conditional_get(self):
+        """
+        Answers requests for an unchanged user with 304 Not Modified,
+        checking only the user's version
+        """
+        self.get_login(self.userOne['email'], self.userOne['password'])
+        url = reverse('users-detail', args=[self.user_two.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # the session and its user; the version comes from the user cache
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        # or else from a query for just the version
+        with self.assertNumQueries(3), mock.patch.dict(
+                'apps.base_accounts.conf.DEFAULTS', {'USER_DATA_CACHE_TTL': 0}):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # other fields, other representation
+        response = self.client.get(url, {'fields': 'email'},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.user_two.first_name = 'Changed'
+        self.user_two.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['first_name'], 'Changed')
+        self.assertNotEqual(response['ETag'], etag)
+
+        token = Token.objects.create(user=self.user_one)
+        url = reverse('users-from-token')
+        response = self.client.get(url, {'token': token.key})
+        etag = response['ETag']
+        response = self.client.get(url, {'token': token.key},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # as every .update() of users does, bump the version and drop the
+        # cached data
+        EmailUser.objects.filter(pk=self.user_one.pk).update(
+            first_name='Updated', updated_at=timezone.now())
+        invalidate_user_data(self.user_one.pk)
+        response = self.client.get(url, {'token': token.key},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['first_name'], 'Updated')
+
+    def test_user_data_cache(self):
+        """
+        Serves repeat reads of a user from the cache, until it changes
+        """
+        self.get_login(self.userOne['email'], self.userOne['password'])
+        url = reverse('users-detail', args=[self.user_two.id])
+        response = self.client.get(url)
+        hits = user_data_stats['hits']
+        # just the session and its user
+        with self.assertNumQueries(2), mock.patch.object(
+                UserSerializer, 'to_representation') as to_representation:
+            cached = self.client.get(url)
+        to_representation.assert_not_called()
+        self.assertEqual(user_data_stats['hits'], hits + 1)
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        # each projection is cached separately
+        response = self.client.get(url, {'fields': 'email'})
+        self.assertEqual(list(response.data), ['email'])
+
+        self.get_login('a@a.com', 'p')
+        self.patch_detail(self.user_two.id, {'first_name': 'Changed'})
+        self.assertEqual(self.client.get(url).data['first_name'], 'Changed')
+        self.user_two.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def request_reset_key(self, email):
+        self.client.post(reverse('reset-password', kwargs={'email': email}))
+        body = QueuedEmail.objects.filter(
+            to_email=email, subject='Password Reset Request').last().body_html
+        return re.search(r'validation_key=([a-z0-9\-]+)', body).group(1)
+
+    def test_reset_password(self):
+        """
+        Resets a password with an emailed key, which only works once
+        """
+        key = self.request_reset_key(self.userOne['email'])
+        self.assertFalse(UserKey.objects.filter(key_hash=key).exists())
+        url = reverse('reset-request', kwargs={'validation_key': key})
+        response = self.client.get(url)
+        self.assertEqual(response.data, self.userOne['email'])
+        response = self.client.post(url, {'password': 'new-password',
+                                          'password_confirm': 'new-password'})
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(self.client.login(email=self.userOne['email'],
+                                          password='new-password'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_reset_password_key_expires(self):
+        """
+        Declines expired reset keys
+        """
+        key = self.request_reset_key(self.userOne['email'])
+        UserKey.objects.update(
+            expires_at=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        response = self.client.get(
+            reverse('reset-request', kwargs={'validation_key': key}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_users(self):
+        """
+        Searches users by name and email
+        """
+        self.get_login(self.userTwo['email'], self.userTwo['password'])
+        response = self.client.get(reverse('users-list'), {'q': 'nameone'})
+        self.assertEqual([user['email'] for user in response.data],
+                         [self.userOne['email']])
+        response = self.client.get(reverse('users-list'),
+                                   {'q': 'example.com firstnamet'})
+        self.assertEqual([user['email'] for user in response.data],
+                         [self.userThree['email'], self.userTwo['email']])
+
+    def test_admin_changelist_age(self):
+        """
+        Sorts and filters the admin user list by age
+        """
+        today = datetime.date.today()
+        EmailUser.objects.filter(pk=self.user_one.pk).update(
+            birthdate=today.replace(year=today.year - 30))
+        EmailUser.objects.filter(pk=self.user_two.pk).update(
+            birthdate=today.replace(year=today.year - 20))
+        self.get_login('a@a.com', 'p')
+        url = reverse('admin:accounts_emailuser_changelist')
+        # age is the 7th column
+        response = self.client.get(url, {'o': '7'})
+        ages = [user.age_years for user in response.context['cl'].result_list
+                if user.age_years is not None]
+        self.assertEqual(ages, [20, 30])
+        response = self.client.get(url, {'age': '25-34'})
+        self.assertEqual(
+            [user.email for user in response.context['cl'].result_list],
+            [self.userOne['email']])
+
+        # searches keep the order of search_users, unless sorted
+        with mock.patch('apps.base_accounts.admin.search_users',
+                        side_effect=lambda queryset, query:
+                        queryset.order_by('-first_name')):
+            response = self.client.get(url, {'q': 'example'})
+            self.assertEqual(
+                [user.first_name for user in
+                 response.context['cl'].result_list][:3],
+                ['FirstNameTwo', 'FirstNameThree', 'FirstNameOne'])
+            response = self.client.get(url, {'q': 'example', 'o': '1'})
+            emails = [user.email
+                      for user in response.context['cl'].result_list]
+            self.assertEqual(emails, sorted(emails))
+
+        model_admin = admin.site._registry[EmailUser]
+        EmailUser.objects.filter(pk=self.user_three.pk).update(
+            birthdate=today)
+        response = self.client.get(url)
+        ages = {user.email: model_admin.age(user)
+                for user in response.context['cl'].result_list}
+        self.assertEqual(ages[self.userThree['email']], 0)
+        self.assertEqual(ages['a@a.com'], model_admin.get_empty_value_display())
+        self.assertEqual(model_admin.age(self.user_one),
+                         model_admin.get_empty_value_display())
+
+    def test_upload_image(self):
+        """
+        Stores uploads once under their content hash, with a size limit
+        """
+        buffer = io.BytesIO()
+        Image.new('RGB', (40, 40), (10, 20, 30)).save(buffer, 'PNG')
+        content = buffer.getvalue()
+        content_hash = hashlib.sha256(content).hexdigest()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        def upload(user):
+            self.get_login(user.email, 'p')
+            upload_file = io.BytesIO(content)
+            upload_file.name = 'me.PNG'
+            return self.client.post(
+                reverse('users-upload-image', args=[user.id]),
+                {'file': upload_file})
+
+        with override_settings(MEDIA_ROOT=media_root), \
+                mock.patch.object(EmailUser, 'schedule_image_processing'):
+            response = upload(self.user_one)
+            self.assertEqual(response.status_code, 200)
+            name = 'images/{}/{}.png'.format(content_hash[:2], content_hash)
+            self.assertEqual(EmailUser.objects.get(pk=self.user_one.pk)
+                             .image.name, name)
+            self.assertEqual(upload(self.user_two).status_code, 200)
+            self.assertEqual(EmailUser.objects.get(pk=self.user_two.pk)
+                             .image.name, name)
+            self.assertEqual(os.listdir(os.path.join(
+                media_root, 'images', content_hash[:2])),
+                [content_hash + '.png'])
+
+            with mock.patch.dict('apps.base_accounts.conf.DEFAULTS',
+                                 {'IMAGE_UPLOAD_MAX_SIZE': 100}):
+                response = upload(self.user_three)
+            self.assertEqual(response.status_code, 413)
+            self.assertFalse(
+                EmailUser.objects.get(pk=self.user_three.pk).image)
+
+            request = RequestFactory().get('/media/' + name)
+            response = serve_media(request, name, document_root=media_root)
+            self.assertIn('immutable', response['Cache-Control'])
+
+    def test_export(self):
+        """
+        Streams users to admins as NDJSON or CSV
+        """
+        url = reverse('users-export')
+        self.get_login(self.userOne['email'], self.userOne['password'])
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.get_login('a@a.com', 'p')
+        response = self.client.get(url, {'fields': 'id,email'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted(row['email'] for row in rows), sorted(
+            EmailUser.objects.values_list('email', flat=True)))
+        self.assertEqual(set(rows[0]), {'id', 'email'})
+
+        EmailUser.objects.filter(pk=self.user_one.pk).update(
+            date_joined=datetime.datetime(2000, 1, 1,
+                                          tzinfo=datetime.timezone.utc))
+        EmailUser.objects.filter(pk=self.user_two.pk).update(
+            first_name='=HYPERLINK("http://example.com")')
+        response = self.client.get(url, {'file_format': 'csv',
+                                         'since': '2001-01-01'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), EmailUser.objects.count())
+        self.assertIn('email', lines[0].split(','))
+        self.assertNotIn(self.userOne['email'], '\n'.join(lines))
+        # names aren't exported as formulas
+        self.assertIn('"\'=HYPERLINK(""http://example.com"")"',
+                      '\n'.join(lines))
+
+        response = self.client.get(url, {'file_format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_multi_get(self):
+        """
+        Gets many users by id with one query, in order, marking the ids
+        that aren't users
+        """
+        self.get_login(self.userOne['email'], self.userOne['password'])
+        missing = '0d7a4f8e-0f6a-4b0c-9d6e-2f5e7e3f2a10'
+        ids = [str(self.user_two.id), 'not-a-uuid', missing,
+               str(self.user_one.id), str(self.user_two.id)]
+        # the session, its user and the users
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('users-list'),
+                                       {'ids': ','.join(ids)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data],
+                         [200, 400, 404, 200, 200])
+        self.assertEqual([result['id'] for result in response.data], ids)
+        self.assertEqual(response.data[0]['data'], self.client.get(
+            reverse('users-detail', args=[self.user_two.id])).data)
+        self.assertEqual(response.data[3]['data']['email'],
+                         self.userOne['email'])
+
+        response = self.client.get(reverse('users-list'), {
+            'ids': ids[0], 'fields': 'email'})
+        self.assertEqual(response.data[0]['data'],
+                         {'email': self.userTwo['email']})
+
+        url = reverse('users-lookup')
+        response = self.client.post(url, json.dumps({'ids': ids}),
+                                    content_type='application/json')
+        self.assertEqual([result['status'] for result in response.data],
+                         [200, 400, 404, 200, 200])
+        with mock.patch.dict('apps.base_accounts.conf.DEFAULTS',
+                             {'USER_MULTI_GET_MAX_IDS': 2}):
+            response = self.client.post(url, json.dumps({'ids': ids}),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # reading users takes a login, even though this is a POST
+        self.client.logout()
+        response = self.client.post(url, json.dumps({'ids': ids}),
+                                    content_type='application/json')
+        self.assertIn(response.status_code, (401, 403))
+
+    def test_bulk(self):
+        """
+        Creates and updates many users at once, reporting on each
+        """
+        url = reverse('users-bulk')
+        self.get_login('a@a.com', 'p')
+        QueuedEmail.objects.all().delete()
+        items = [
+            {'email': 'new1@example.com', 'password': 'p1'},
+            {'id': str(self.user_one.id), 'first_name': 'Renamed',
+             'birthdate': '1980-05-06'},
+            {'email': self.userTwo['email'], 'password': 'p'},
+            {'email': 'new2@example.com', 'password': 'p', 'first_name': 'N'},
+            {'email': 'new2@example.com', 'password': 'p'},
+            {'id': 'not-a-uuid'},
+            {'id': '0d7a4f8e-0f6a-4b0c-9d6e-2f5e7e3f2a10'},
+            {'id': str(self.user_two.id), 'gender': 'x'},
+            {'id': str(self.user_three.id), 'last_name': 'Updated'},
+        ]
+        # the same number of queries however many items there are
+        with self.assertNumQueries(13):
+            response = self.client.post(url, json.dumps(items),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data],
+                         [201, 200, 400, 201, 400, 400, 404, 400, 200])
+        self.assertIn('email', response.data[2]['errors'])
+        self.assertIn('email', response.data[4]['errors'])
+        self.assertIn('gender', response.data[7]['errors'])
+
+        new_user = EmailUser.objects.get(email='new1@example.com')
+        self.assertEqual(response.data[0]['data']['id'], str(new_user.id))
+        self.assertTrue(new_user.check_password('p1'))
+        user_one = EmailUser.objects.get(pk=self.user_one.pk)
+        self.assertEqual(user_one.first_name, 'Renamed')
+        self.assertEqual(user_one.birthdate, datetime.date(1980, 5, 6))
+        self.assertEqual(user_one.last_name, self.userOne['last_name'])
+        self.assertEqual(
+            EmailUser.objects.get(pk=self.user_three.pk).last_name, 'Updated')
+        self.assertEqual(EmailUser.objects.get(pk=self.user_two.pk).gender,
+                         None)
+        # validation emails are queued for the new users only
+        self.assertEqual(sorted(QueuedEmail.objects.values_list(
+            'to_email', flat=True)), ['new1@example.com', 'new2@example.com'])
+        self.assertEqual(UserKey.objects.filter(
+            user__email__startswith='new').count(), 2)
+
+        # another request creates one of the users after they were checked
+        validate_creates = bulk._validate_creates
+
+        def validate_then_race(*args):
+            valid = validate_creates(*args)
+            EmailUser.objects.bulk_create(
+                [EmailUser(email='race2@example.com')])
+            return valid
+
+        with mock.patch.object(bulk, '_validate_creates',
+                               side_effect=validate_then_race):
+            response = self.client.post(url, json.dumps([
+                {'email': 'race1@example.com', 'password': 'p'},
+                {'email': 'race2@example.com', 'password': 'p'},
+            ]), content_type='application/json')
+        self.assertEqual([result['status'] for result in response.data],
+                         [201, 400])
+        self.assertIn('email', response.data[1]['errors'])
+        self.assertTrue(EmailUser.objects.get(
+            email='race1@example.com').check_password('p'))
+
+        self.get_login(self.userOne['email'], self.userOne['password'])
+        response = self.client.post(url, json.dumps(items[:1]),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_command(self):
+        """
+        Exports every user as NDJSON from the command line, in chunks
+        """
+        out = io.StringIO()
+        call_command('export_users', chunk_size=2, stdout=out)
+        emails = [json.loads(line)['email']
+                  for line in out.getvalue().splitlines()]
+        self.assertEqual(sorted(emails), sorted(
+            EmailUser.objects.values_list('email', flat=True)))
+
+    def test_login_failures_are_shed(self):
+        """
+        Rejects logins from IPs and for emails with too many recent
+        failures, without checking their password
+        """
+        EmailUser.objects.filter(pk=self.user_two.pk).update(
+            validated_at=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+
+        def login(email, password, ip='10.0.0.1'):
+            return self.client.post('/api-token-auth/', {
+                'username': email, 'password': password}, REMOTE_ADDR=ip)
+
+        with mock.patch.dict('apps.base_accounts.conf.DEFAULTS', {
+                'LOGIN_MAX_FAILURES_PER_IP': 5,
+                'LOGIN_MAX_FAILURES_PER_EMAIL': 3}):
+            for _ in range(3):
+                self.assertEqual(login(self.userOne['email'], 'x')
+                                 .status_code, 401)
+            with mock.patch('django.contrib.auth.hashers.check_password') \
+                    as check_password:
+                response = login(self.userOne['email'],
+                                 self.userOne['password'])
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response['Retry-After']), 0)
+            check_password.assert_not_called()
+
+            # the IP's other failures count too
+            for _ in range(2):
+                self.assertEqual(login('nobody@example.com', 'x')
+                                 .status_code, 401)
+            self.assertEqual(login(self.userTwo['email'], 'p').status_code,
+                             429)
+            response = login(self.userTwo['email'], 'p', ip='10.0.0.2')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('token', response.data)
+
+            # bodies that aren't objects are rejected, not a server error
+            response = self.client.post(
+                '/api-token-auth/', json.dumps(['x']),
+                content_type='application/json', REMOTE_ADDR='10.0.0.3')
+            self.assertIn(response.status_code, (400, 401))
+
+    def test_email_sending_is_throttled(self):
+        """
+        Throttles password reset requests and sign ups per client IP, per
+        email and overall
+        """
+        def reset(email, ip):
+            return self.client.post(
+                reverse('reset-password', kwargs={'email': email}),
+                REMOTE_ADDR=ip)
+
+        with mock.patch.dict('apps.base_accounts.conf.DEFAULTS', {
+                'THROTTLE_RATES': {
+                    'reset_password': {'ip': '3/hour', 'email': '2/hour',
+                                       'global': '4/hour'},
+                    'create_user': {'ip': '1/hour'}}}):
+            self.assertEqual(reset(self.userOne['email'], '10.0.0.1')
+                             .status_code, 202)
+            self.assertEqual(reset(self.userOne['email'], '10.0.0.1')
+                             .status_code, 202)
+            response = reset(self.userOne['email'], '10.0.0.2')
+            self.assertEqual(response.status_code, 429)
+            # a token comes back every hour / 2
+            self.assertAlmostEqual(int(response['Retry-After']), 1800,
+                                   delta=5)
+            self.assertEqual(reset(self.userTwo['email'], '10.0.0.1')
+                             .status_code, 202)
+            self.assertEqual(reset(self.userThree['email'], '10.0.0.1')
+                             .status_code, 429)
+            self.assertEqual(reset(self.userThree['email'], '10.0.0.3')
+                             .status_code, 202)
+            self.assertEqual(reset('a@a.com', '10.0.0.4').status_code, 429)
+
+            def create(email):
+                return self.client.post(reverse('users-list'), {
+                    'email': email, 'password': 'p'}, REMOTE_ADDR='10.0.0.1')
+
+            self.assertEqual(create('new1@example.com').status_code, 201)
+            self.assertEqual(create('new2@example.com').status_code, 429)
+            # admins aren't throttled
+            self.get_login('a@a.com', 'p')
+            self.assertEqual(create('new2@example.com').status_code, 201)
+
+
+class LoadDataTestCase(TestCase):
+    def test_iter_json_objects(self):
+        objects = [{'email': 'user{}@example.com'.format(i), 'n': [i] * i}
+                   for i in range(50)]
+        for text in (json.dumps(objects, indent=2),
+                     '\n'.join(json.dumps(obj) for obj in objects)):
+            self.assertEqual(
+                list(iter_json_objects(io.StringIO(text), chunk_size=7)),
+                objects)
+        with self.assertRaises(ValueError):
+            list(iter_json_objects(io.StringIO('[{"a": 1}, {"b"')))
+
+    def test_load_users(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'accounts.EmailUser.json'),
+                  'w') as f:
+            json.dump([
+                {'email': 'load{}@example.com'.format(i), 'password': 'p',
+                 'birthdate': '1990-01-02'} for i in range(5)
+            ] + [{'pk': '0d7a4f8e-0f6a-4b0c-9d6e-2f5e7e3f2a10',
+                  'fields': {'email': 'fixture@example.com'}}], f)
+        call_command('load_data', directory=directory, batch_size=2,
+                     workers=1, stdout=io.StringIO())
+        users = EmailUser.objects.filter(email__startswith='load')
+        self.assertEqual(users.count(), 5)
+        self.assertTrue(users[0].check_password('p'))
+        self.assertEqual(users[0].birthdate, datetime.date(1990, 1, 2))
+        fixture_user = EmailUser.objects.get(email='fixture@example.com')
+        self.assertEqual(str(fixture_user.pk),
+                         '0d7a4f8e-0f6a-4b0c-9d6e-2f5e7e3f2a10')
+        self.assertFalse(fixture_user.has_usable_password())
+        # bulk loads don't send validation emails
+        self.assertFalse(QueuedEmail.objects.exists())
+
+
+def _hammer_cache(cache, worker, iterations):
+    for i in range(iterations):
+        cache.incr('counter')
+        cache.set('worker-{}-{}'.format(worker, i % 50), (worker, i) * 20)
+        value = cache.get('worker-{}-{}'.format(worker, i % 50))
+        if value != (worker, i) * 20:
+            os._exit(1)
+        cache.get('worker-{}-{}'.format((worker + 1) % 8, i % 50))
+    os._exit(0)
+
+
+class SharedMemoryCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        fd, self.location = tempfile.mkstemp(prefix='radius-cache-test-')
+        os.close(fd)
+        self.cache = self.make_cache()
+
+    def tearDown(self):
+        os.remove(self.location)
+
+    def make_cache(self, **options):
+        return SharedMemoryCache(self.location, {'OPTIONS': dict(
+            {'MAX_ENTRIES': 256, 'MAX_VALUE_SIZE': 512}, **options)})
+
+    def test_get_set_delete(self):
+        self.cache.set('a', {'b': 1})
+        self.assertEqual(self.cache.get('a'), {'b': 1})
+        self.assertFalse(self.cache.add('a', 2))
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.add('a', 2))
+        self.assertEqual(self.cache.incr('a', 3), 5)
+
+    def test_shared_between_instances(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.make_cache().get('a'), 1)
+        self.make_cache().delete('a')
+        self.assertFalse(self.cache.has_key('a'))
+
+    def test_expiry_and_size_limit(self):
+        self.cache.set('expired', 1, timeout=-1)
+        self.assertIsNone(self.cache.get('expired'))
+        self.cache.set('big', 'small')
+        self.cache.set('big', 'x' * 1000)
+        self.assertIsNone(self.cache.get('big'))
+
+    def test_lru_eviction(self):
+        for i in range(1000):
+            self.cache.set('key-{}'.format(i), i)
+            # keep the first key hot
+            self.assertEqual(self.cache.get('key-0'), 0)
+        self.assertEqual(self.cache.get('key-999'), 999)
+        self.assertLessEqual(
+            sum(self.cache.has_key('key-{}'.format(i)) for i in range(1000)),
+            256)
+
+    def test_torn_entry_is_a_miss(self):
+        self.cache.set('a', 'value')
+        self.cache.set('b', 1)
+        key_hash = self.cache._key_hash('a', None)
+        offset = self.cache._offset(self.cache._find(key_hash, time.time()))
+        # as if a writer died after the header, before the value
+        self.cache._map[offset + SLOT.size:offset + SLOT.size + 4] = b'\0' * 4
+        self.assertIsNone(self.cache.get('a'))
+        self.assertFalse(self.cache.has_key('a'))
+        self.assertEqual(self.cache.get('b'), 1)
+        self.cache.set('a', 'again')
+        self.assertEqual(self.cache.get('a'), 'again')
+
+    def test_layout_change_replaces_file(self):
+        """
+        A process with other options gets a new file, and processes that
+        mapped the old one keep working
+        """
+        self.cache.set('a', 1)
+        other = self.make_cache(MAX_VALUE_SIZE=1024)
+        self.assertIsNone(other.get('a'))
+        other.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertEqual(self.make_cache(MAX_VALUE_SIZE=1024).get('b'), 2)
+
+    def test_concurrent_processes(self):
+        """
+        Forked workers share the cache without losing updates or reading
+        torn values.
+        """
+        self.cache = self.make_cache(MAX_ENTRIES=4096)
+        self.cache.set('counter', 0)
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=_hammer_cache, args=(self.cache, i, 300))
+            for i in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers], [0] * 8)
+        self.assertEqual(self.cache.get('counter'), 8 * 300)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='radius-metrics-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        EmailUser.objects.create_superuser('a@a.com', 'p')
+        self.client.login(email='a@a.com', password='p')
+
+    def get_value(self, text, name, **labels):
+        """The value of a sample, or 0 if it's missing."""
+        for line in text.splitlines():
+            sample, _, value = line.rpartition(' ')
+            if sample.startswith(name + '{') and all(
+                    '{}="{}"'.format(label, value) in sample
+                    for label, value in labels.items()):
+                return float(value)
+        return 0
+
+    def test_metrics(self):
+        """
+        Records requests by URL name, adding up the metrics of every worker
+        """
+        with override_settings(METRICS_DIR=self.directory):
+            url = reverse('metrics')
+            text = self.client.get(url).content.decode()
+            before = self.get_value(
+                text, 'radius_http_requests_total', view='users-list',
+                method='GET', status='200')
+            queries_before = self.get_value(
+                text, 'radius_http_request_queries_sum', view='users-list',
+                method='GET')
+            connection.queries_log.clear()
+            for _ in range(2):
+                self.client.get(reverse('users-list'))
+            # counted without logging them
+            self.assertEqual(len(connection.queries_log), 0)
+
+            # the files of a worker that is still running, and of one that
+            # has exited
+            for name in ('1-100', '2-100'):
+                with open(os.path.join(self.directory, name + '.json'),
+                          'w') as f:
+                    json.dump([{
+                        'view': 'users-list', 'method': 'GET',
+                        'statuses': {'200': 5},
+                        'duration': [5] + [0] * 11, 'duration_sum': 0.01,
+                        'queries': [0, 5] + [0] * 8, 'queries_sum': 5,
+                        'sql_seconds_sum': 0.001,
+                    }], f)
+            running = open(os.path.join(self.directory, '1-100.lock'), 'w')
+            self.addCleanup(running.close)
+            fcntl.flock(running, fcntl.LOCK_EX)
+            response = self.client.get(url)
+            # the exited worker's numbers are kept in the retired file
+            self.assertEqual(
+                sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(('1-', '2-', 'retired'))),
+                ['1-100.json', '1-100.lock', 'retired.json'])
+            again = self.client.get(url).content.decode()
+        for name in ('radius_http_requests_total',
+                     'radius_http_request_queries_sum'):
+            self.assertEqual(
+                self.get_value(again, name, view='users-list'),
+                self.get_value(response.content.decode(), name,
+                               view='users-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertEqual(self.get_value(
+            text, 'radius_http_requests_total', view='users-list',
+            method='GET', status='200'), before + 12)
+        self.assertEqual(self.get_value(
+            text, 'radius_http_request_duration_seconds_bucket',
+            view='users-list', method='GET', le='+Inf'), before + 12)
+        # the session, its user and the list
+        self.assertEqual(self.get_value(
+            text, 'radius_http_request_queries_sum', view='users-list',
+            method='GET'), queries_before + 10 + 2 * 3)
+        self.assertIn('# TYPE radius_http_request_sql_seconds_total counter',
+                      text)
+
+        self.client.logout()
+        self.assertIn(self.client.get(url).status_code, (401, 403))
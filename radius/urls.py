@@ -5,12 +5,13 @@ from django.contrib import admin
 from django.utils.safestring import mark_safe
 from django.views.generic.base import RedirectView
 from apps.base_accounts.views import obtain_auth_token, \
-    ValidateUserView, ResetPassword, RequestPasswordChange
+    ValidateUserView, ResetPassword, RequestPasswordChange, serve_media
 # from apps.base_accounts.admin import admin_cleanup # TODO admin_cleanup?
 from rest_framework.routers import DefaultRouter
 
 from apps.landing.views import LandingView
 from apps.accounts.views import UserViewSet
+from radius.metrics import MetricsView
 
 admin.site.site_title = admin.site.index_title = "radius"
 admin.site.site_header = mark_safe('<img src="{img}" alt="{alt}"/>'.format(
@@ -37,6 +38,7 @@ urlpatterns = [
     url(r'^api-auth/', include('rest_framework.urls',
                                namespace='rest_framework')),
     url(r'^api-token-auth/', obtain_auth_token),
+    url(r'^metrics$', MetricsView.as_view(), name='metrics'),
     url(r'reset-password/(?P<email>[a-zA-Z0-9-.+@_]+)/$',
         RequestPasswordChange.as_view(), name='reset-password'),
     url(r'reset/(?P<validation_key>[a-z0-9\-]+)/$',
@@ -46,4 +48,5 @@ urlpatterns = [
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    urlpatterns += static(settings.MEDIA_URL, view=serve_media,
+                          document_root=settings.MEDIA_ROOT)